@@ -1,4 +1,8 @@
+import multiprocessing
+
 from src.UploadTool import UploadTool
 
 if __name__ == "__main__":
+    # 打包后的程序需要这一行才能正常使用进程池
+    multiprocessing.freeze_support()
     UploadTool().main()
@@ -1,4 +1,4 @@
-import json
+import os
 import sys
 import traceback
 import oss2
@@ -15,8 +15,13 @@ from src.service_provider.TencentCOS import TencentCOS
 from src.utilities.dir_hash import dir_hash
 from src.exception.NoServiceProviderFoundError import NoServiceProviderFoundError
 from src.exception.ParameterError import ParameterError
+from src.exception.UploadFailedError import UploadFailedError
 from src.utilities.file import File
-from src.utilities.file_comparer import FileComparer2
+from src.utilities.file_comparer import FileComparer2, compareStrategies
+from src.utilities.hash_algorithms import hashAlgorithms, dump_structure, load_structure, first_file, strip_structure
+from src.utilities.hash_index import HashIndex
+from src.utilities.local_snapshot import LocalSnapshot
+from src.utilities.upload_scheduler import schedule_uploads, stream_uploads
 from src.service_provider.AbstractServiceProvider import AbstractServiceProvider
 
 
@@ -33,6 +38,8 @@ class UploadTool:
         self.configFile = File(sys.executable).parent(filename) if not inDev else File(filename)
         self.config = None
         self.source = None
+        self.snapshot = None
+        self.compareStrategy = 'strict'
         self.debugMode = False
 
     def checkParam(self):
@@ -52,7 +59,7 @@ class UploadTool:
             if d.isDirectory:
                 print(f'正在生成结构文件 {d.name}.yml')
 
-                content = yaml.dump(dir_hash(d), canonical=True)
+                content = yaml.dump(strip_structure(dir_hash(d)), canonical=True)
                 d.parent(d.name + '.yml').content = content
 
     def uploadingMode(self, providerName):
@@ -69,74 +76,36 @@ class UploadTool:
             print('上传到' + client.getName())
             client.initialize(self.source)
 
-            # 生成结构文件
-            if not self.config.get('upload_only', False):
-                for f in [file for file in self.source if file.isDirectory]:
-                    print(f'正在生成结构文件 {f.name}.json')
-
-                    content = json.dumps(dir_hash(f), ensure_ascii=False)
-                    # content = yaml.dump(dir_hash(f), canonical=True)
-                    f.parent(f.name + '.json').content = content
-
-            # 获取远程文件目录
-            print('正在获取远程文件目录..')
-            remote = client.fetchAll()
-
-            # 计算文件差异
-            print('正在计算文件差异..')
-            cp = FileComparer2(self.source, client.compareFile)
-            cp.compareWithList(self.source, remote)
-
-            # 输出差异结果
-            if sum([len(cp.oldFolders), len(cp.oldFiles), len(cp.newFolders), len(cp.newFiles)]) == 0:
-                print('无差异')
+            # 文件对比策略
+            self.compareStrategy = self.config.get('compare_strategy', 'strict')
+            if self.compareStrategy not in compareStrategies:
+                raise ParameterError(f'未知的文件对比策略: <{self.compareStrategy}>, 可用值: ' + str(list(compareStrategies)))
+
+            # 本地校验索引，跳过没有变化的文件(paranoid策略总是重新计算校验)
+            indexFileName = self.config.get('hash_index', '.hash_index.db')
+            useIndex = indexFileName and self.compareStrategy != 'paranoid'
+            index = HashIndex(self.configFile.parent(indexFileName)) if useIndex else None
+
+            # 并行计算校验的线程/进程数
+            hashWorkers = self.config.get('hash_workers', 'auto')
+            hashWorkers = (os.cpu_count() or 1) if hashWorkers == 'auto' else int(hashWorkers)
+
+            # 校验算法，结构文件默认使用sha1以兼容更新客户端
+            hashAlgorithm = self.config.get('hash_algorithm', 'sha1')
+            structureHashAlgorithm = self.config.get('structure_hash_algorithm', 'sha1')
+            for algorithm in [hashAlgorithm, structureHashAlgorithm]:
+                if algorithm not in hashAlgorithms:
+                    raise ParameterError(f'未知的校验算法: <{algorithm}>, 可用值: ' + str([k for k in hashAlgorithms.keys()]))
+
+            # 本地文件结构只扫描一次，后续的差异计算和缓存更新都复用
+            self.snapshot = LocalSnapshot(self.source, index, hashWorkers, hashAlgorithm)
+
+            # 流水线模式：边计算校验边对比边上传
+            streaming = self.config.get('streaming', False) and isinstance(client, ParallelUploadServiceProvider)
+            if streaming:
+                self.streamingUpload(client, index, hashAlgorithm, structureHashAlgorithm)
             else:
-                print(f'旧文件: {len(cp.oldFiles)}')
-                print(f'旧目录: {len(cp.oldFolders)}')
-                print(f'新文件: {len(cp.newFiles)}')
-                print(f'新目录: {len(cp.newFolders)}')
-
-            # 输出文件碎片
-            fragments = client.fetchFragments()
-            if len(fragments) > 0:
-                for f in fragments:
-                    print('文件碎片: ' + f)
-
-            # 删除旧文件
-            if len(cp.oldFiles) > 0 or len(cp.oldFolders) > 0:
-                print('')
-                for f in cp.oldFiles:
-                    print('删除远程文件: ' + f)
-                for f in cp.oldFolders:
-                    print('删除远程目录: ' + f + '/')
-                if len(cp.oldFiles) > 0:
-                    client.deleteObjects(cp.oldFiles)
-                if len(cp.oldFolders) > 0:
-                    client.deleteDirectories(cp.oldFolders)
-
-            # 创建新目录
-            if len(cp.newFolders) > 0:
-                print('')
-                count = 0
-                for path in cp.newFolders:
-                    count += 1
-                    print(f'创建目录({count}/{len(cp.newFolders)}): {path}')
-                    client.makeDirectory(path)
-
-            # 上传新文件
-            if len(cp.newFiles) > 0:
-                print('')
-                count = 0
-                for path, v in cp.newFiles.items():
-                    length = v[0]
-                    hash = v[1]
-                    localFile = self.source(path)
-                    if not isinstance(client, ParallelUploadServiceProvider):
-                        count += 1
-                        print(f'上传本地文件({count}/{len(cp.newFiles)}): {path}')
-                    client.uploadObject(path, localFile.path, self.source.path, length, hash)
-                if isinstance(client, ParallelUploadServiceProvider):
-                    client.startParallelUploadWork()
+                self.phasedUpload(client, index, hashAlgorithm, structureHashAlgorithm)
 
             # 清理退出
             client.cleanup()
@@ -146,9 +115,178 @@ class UploadTool:
                 for f in [file for file in self.source if file.isDirectory]:
                     f.parent(f.name + '.json').delete()
 
+            if isinstance(client, ParallelUploadServiceProvider) and len(client.uploadFailures) > 0:
+                raise UploadFailedError(f'有{len(client.uploadFailures)}个文件上传失败，请重新运行以继续上传')
+
         else:
             raise NoServiceProviderFoundError(f'未知的服务提供商: <{providerName}>, 可用值: ' + str([k for k in self.serviceProviders.keys()]))
 
+    def phasedUpload(self, client: AbstractServiceProvider, index: HashIndex, hashAlgorithm: str,
+                     structureHashAlgorithm: str):
+        """依次生成结构文件、计算全部差异、删除、创建目录，最后上传"""
+        # 获取远程文件目录(metadata策略需要在计算本地校验之前拿到远程缓存)
+        print('正在获取远程文件目录..')
+        remote, compareAlgorithm = self.loadRemote(client, hashAlgorithm, structureHashAlgorithm)
+
+        # 生成结构文件
+        if not self.config.get('upload_only', False):
+            self.generateStructureFiles(structureHashAlgorithm)
+
+        # 计算文件差异(使用远程缓存的校验算法计算本地校验，更新缓存时再迁移到新的算法)
+        print('正在计算文件差异..')
+        cp = FileComparer2(self.source, client.compareFile)
+        cp.compareWithList(self.snapshot.getStructure(compareAlgorithm), remote)
+
+        # 保存本地校验索引
+        if index is not None:
+            index.prune(self.source)
+            index.save()
+            index.close()
+
+        # 输出差异结果
+        if sum([len(cp.oldFolders), len(cp.oldFiles), len(cp.newFolders), len(cp.newFiles)]) == 0:
+            print('无差异')
+        else:
+            print(f'旧文件: {len(cp.oldFiles)}')
+            print(f'旧目录: {len(cp.oldFolders)}')
+            print(f'新文件: {len(cp.newFiles)}')
+            print(f'新目录: {len(cp.newFolders)}')
+
+        self.printFragments(client)
+        self.deleteOldFiles(client, cp)
+        self.createNewFolders(client, cp)
+
+        # 上传新文件
+        if len(cp.newFiles) > 0:
+            print('')
+            count = 0
+            parallel = isinstance(client, ParallelUploadServiceProvider)
+            batchSize = self.config.get('upload_batch_size', 32) if parallel else 1
+            for batch in schedule_uploads(cp.newFiles, batchSize):
+                if not parallel:
+                    for path, length, hash in batch:
+                        count += 1
+                        print(f'上传本地文件({count}/{len(cp.newFiles)}): {path}')
+                files = [(path, self.source(path).path, length, hash) for path, length, hash in batch]
+                client.uploadObjects(files, self.source.path)
+            if parallel:
+                client.startParallelUploadWork(self.config.get('upload_threads', 16))
+
+    def streamingUpload(self, client: ParallelUploadServiceProvider, index: HashIndex, hashAlgorithm: str,
+                        structureHashAlgorithm: str):
+        """流水线模式：先根据文件名删除旧文件、创建新目录，然后一边计算校验对比一边上传
+
+        结构文件需要所有文件的校验，所以放到最后生成并上传
+        """
+        uploadOnly = self.config.get('upload_only', False)
+        structureFiles = [] if uploadOnly else [f.name + '.json' for f in self.source if f.isDirectory]
+
+        # 获取远程文件目录
+        print('正在获取远程文件目录..')
+        remote, compareAlgorithm = self.loadRemote(client, hashAlgorithm, structureHashAlgorithm)
+
+        # 只扫描本地文件，校验在上传过程中计算
+        print('正在扫描本地文件..')
+        structure, files = self.snapshot.streamStructure(compareAlgorithm, structureFiles)
+        cp = FileComparer2(self.source, client.compareFile)
+        cp.prepareStreaming(structure, remote, structureFiles)
+
+        print(f'旧文件: {len(cp.oldFiles)}')
+        print(f'旧目录: {len(cp.oldFolders)}')
+        print(f'新目录: {len(cp.newFolders)}')
+        self.printFragments(client)
+        self.deleteOldFiles(client, cp)
+        self.createNewFolders(client, cp)
+
+        def changes():
+            yield from cp.iterNewFiles(files)
+            if not uploadOnly:
+                self.generateStructureFiles(structureHashAlgorithm)
+                yield from cp.iterNewFiles(self.snapshot.addFiles(structureFiles, compareAlgorithm))
+
+        print('')
+        batchSize = self.config.get('upload_batch_size', 32)
+        batches = ([(path, self.source(path).path, length, hash) for path, length, hash in batch]
+                   for batch in stream_uploads(changes(), batchSize))
+        client.startParallelUploadWork(self.config.get('upload_threads', 16), batches, self.source.path)
+        print(f'新文件: {len(cp.newFiles)}')
+
+        # 保存本地校验索引
+        if index is not None:
+            index.prune(self.source)
+            index.save()
+            index.close()
+
+    def loadRemote(self, client: AbstractServiceProvider, hashAlgorithm: str, structureHashAlgorithm: str):
+        """获取远程文件目录，并在计算任何本地校验之前确定本次运行需要的校验算法
+        :return: (远程目录结构, 对比时使用的校验算法)
+        """
+        remote, remoteHashAlgorithm = load_structure(client.fetchAll())
+
+        # 使用远程缓存的校验算法对比，更新缓存时再迁移到新的算法；只有目录列表(没有校验)时直接使用配置的算法
+        compareAlgorithm = remoteHashAlgorithm or hashAlgorithm
+        if remoteHashAlgorithm is not None and remoteHashAlgorithm != hashAlgorithm:
+            print(f'远程缓存的校验算法({remoteHashAlgorithm})与配置({hashAlgorithm})不同，上传结束后会更新缓存')
+            client.modified = True
+
+        # 所有算法在同一次读取中一起计算
+        algorithms = [compareAlgorithm, hashAlgorithm]
+        if not self.config.get('upload_only', False):
+            algorithms.append(structureHashAlgorithm)
+        # 没有缓存时用对象存储列出的ETag对比，需要本地文件的MD5
+        if remoteHashAlgorithm is None and 'etag' in (first_file(remote) or {}):
+            algorithms.append('md5')
+        self.snapshot.require(algorithms)
+
+        # metadata策略：大小和修改时间没变的文件直接使用远程缓存里的校验
+        if self.compareStrategy == 'metadata' and remoteHashAlgorithm is not None and \
+                self.snapshot.trustRemote(remote, remoteHashAlgorithm):
+            print('远程缓存中没有记录修改时间，上传结束后会更新缓存')
+            client.modified = True
+        return remote, compareAlgorithm
+
+    def generateStructureFiles(self, algorithm: str):
+        """为每个顶层目录生成结构文件<dir>.json"""
+        for f in [file for file in self.source if file.isDirectory]:
+            print(f'正在生成结构文件 {f.name}.json')
+
+            content = dump_structure(strip_structure(self.snapshot.directory(f.name, algorithm)), algorithm)
+            # content = yaml.dump(dir_hash(f), canonical=True)
+            f.parent(f.name + '.json').content = content
+
+    @staticmethod
+    def printFragments(client: AbstractServiceProvider):
+        """输出文件碎片"""
+        fragments = client.fetchFragments()
+        if len(fragments) > 0:
+            for f in fragments:
+                print('文件碎片(上传时会尝试续传): ' + f)
+
+    @staticmethod
+    def deleteOldFiles(client: AbstractServiceProvider, cp: FileComparer2):
+        """删除旧文件和旧目录"""
+        if len(cp.oldFiles) > 0 or len(cp.oldFolders) > 0:
+            print('')
+            for f in cp.oldFiles:
+                print('删除远程文件: ' + f)
+            for f in cp.oldFolders:
+                print('删除远程目录: ' + f + '/')
+            if len(cp.oldFiles) > 0:
+                client.deleteObjects(cp.oldFiles)
+            if len(cp.oldFolders) > 0:
+                client.deleteDirectories(cp.oldFolders)
+
+    @staticmethod
+    def createNewFolders(client: AbstractServiceProvider, cp: FileComparer2):
+        """创建新目录"""
+        if len(cp.newFolders) > 0:
+            print('')
+            count = 0
+            for path in cp.newFolders:
+                count += 1
+                print(f'创建目录({count}/{len(cp.newFolders)}): {path}')
+                client.makeDirectory(path)
+
     def main(self):
         isHashMode = False
 
@@ -164,6 +302,11 @@ class UploadTool:
                 self.config = yaml.safe_load(self.configFile.content)
 
                 self.debugMode = self.config['debug'] if 'debug' in self.config else False
+                # 为0时读取会立即结束，所有文件都会得到空内容的校验
+                hashBlockSize = self.config.get('hash_block_size', File.hashBlockSize)
+                if not isinstance(hashBlockSize, int) or isinstance(hashBlockSize, bool) or hashBlockSize <= 0:
+                    raise ParameterError(f'无效的读取块大小(hash_block_size): <{hashBlockSize}>, 必须是大于0的整数')
+                File.hashBlockSize = hashBlockSize
 
                 self.uploadingMode(self.config['service_provider'])
                 isHashMode = False
@@ -0,0 +1,2 @@
+class UploadFailedError(Exception):
+    pass
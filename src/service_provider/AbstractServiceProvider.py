@@ -3,7 +3,7 @@ from abc import ABC, abstractmethod
 from queue import Queue
 
 from src.utilities.file import File
-from src.utilities.file_comparer import SimpleFileObject
+from src.utilities.file_comparer import SimpleFileObject, compareByHash
 
 
 class AbstractServiceProvider(ABC):
@@ -45,18 +45,38 @@ class AbstractServiceProvider(ABC):
         """
         pass
 
+    def uploadObjects(self, files: list, baseDir):
+        """批量文件上传回调，默认逐个调用uploadObject()
+        :param files: [(相对路径, 本地文件绝对路径, 文件大小, 文件校验)]
+        :param baseDir: 本地根目录的路径
+        """
+        for path, localPath, length, hash in files:
+            self.uploadObject(path, localPath, baseDir, length, hash)
+
     @abstractmethod
     def makeDirectory(self, path):
         """创建文件夹回调"""
         pass
 
-    def compareFile(self, remote: SimpleFileObject, local: str, path: str):
+    def compareFile(self, remote: SimpleFileObject, local: SimpleFileObject, path: str):
         """文件对比回调
         :param remote: 远程文件对象
-        :param local: 本地文件路径
+        :param local: 本地文件对象(来自本地快照，已经计算好校验)
         :param path: 相对路径
         """
-        return remote.sha1 == File(local).sha1
+        if remote.hash == '' and remote.etag is not None:
+            return self.compareWithEtag(remote, local, path)
+        return compareByHash(remote, local, path)
+
+    def compareWithEtag(self, remote: SimpleFileObject, local: SimpleFileObject, path: str):
+        """没有缓存文件时，使用对象存储列出的大小和ETag对比文件"""
+        if remote.length != local.length:
+            return False
+        # 分片上传的对象的ETag不是文件内容的MD5，无法对比，只能重新上传
+        if '-' in remote.etag:
+            return False
+        # MD5在本地快照计算校验时一起算好(见UploadTool.loadRemote)，不再单独读取文件
+        return remote.etag.lower() == self.uploadTool.snapshot.lookup(path, 'md5')
 
     def cleanup(self):
         """清理退出回调"""
@@ -1,16 +1,34 @@
-import json
+import os
 import re
+import time
 from io import BytesIO, BufferedRandom
+from threading import BoundedSemaphore
 
 import oss2
 import yaml
 
-from src.utilities.dir_hash import dir_hash
 from src.utilities.file import File
-from src.service_provider.AbstractServiceProvider import AbstractServiceProvider
+from src.utilities.key_structure import keys_to_structure
+from src.service_provider.ParallelUploadServiceProvider import ParallelUploadServiceProvider
 
 
-class AliyunOSS(AbstractServiceProvider):
+class ThrottledBucket(oss2.Bucket):
+    """上传请求(包括resumable_upload内部线程上传的分片)都要先获取一个连接数，避免总并发数超过连接池大小"""
+
+    def __init__(self, *args, slots: BoundedSemaphore, **kwargs):
+        super(ThrottledBucket, self).__init__(*args, **kwargs)
+        self.slots = slots
+
+    def put_object(self, *args, **kwargs):
+        with self.slots:
+            return super(ThrottledBucket, self).put_object(*args, **kwargs)
+
+    def upload_part(self, *args, **kwargs):
+        with self.slots:
+            return super(ThrottledBucket, self).upload_part(*args, **kwargs)
+
+
+class AliyunOSS(ParallelUploadServiceProvider):
     def __init__(self, uploadTool, config):
         super(AliyunOSS, self).__init__(uploadTool, config)
 
@@ -22,8 +40,16 @@ class AliyunOSS(AbstractServiceProvider):
         access_key = config['access_key']
         region = config['region']
         bucket = config['bucket']
-        self.bucket = oss2.Bucket(oss2.Auth(access_id, access_key), region, bucket)
-        oss2.defaults.connection_pool_size = 4  # 设置最大并发数限制
+        uploadThreads = uploadTool.config.get('upload_threads', 16)
+        # 连接池需要在创建Bucket之前设置，大小与上传线程数一致
+        oss2.defaults.connection_pool_size = max(uploadThreads, 4)
+        # 所有线程共享的连接数限制，单文件上传和分片上传都要先获取
+        self.bucket = ThrottledBucket(oss2.Auth(access_id, access_key), region, bucket,
+                                      slots=BoundedSemaphore(uploadThreads))
+        self.multipartThreshold = config.get('multipart_threshold', 10 * 1024 * 1024)  # 超过这个大小才使用分片上传
+        self.partThreads = config.get('part_threads', 4)  # 单个文件同时上传的分片数
+        # 分片上传的断点记录保存在配置文件旁边，中断后再次上传同一个文件时会从断点处续传
+        self.resumableStore = oss2.ResumableStore(root=uploadTool.configFile.parent.path, dir='.oss_upload')
 
         self.cacheFileName = config['cache_file']
         self.headerRules = config['header_rules'] if 'header_rules' in config else []
@@ -32,50 +58,16 @@ class AliyunOSS(AbstractServiceProvider):
     def initialize(self, rootDir: File):
         self.rootDir = rootDir
 
-    def fetchDirectory(self, path='', i=''):
-        directory = []
-
-        pureName2 = path[:path.rfind('/')]
-        pureName2 = pureName2[pureName2.rfind('/') + 1:]
-        print(i + pureName2)
-
-        d = []
-
-        for obj in oss2.ObjectIteratorV2(self.bucket, prefix=path, delimiter='/', fetch_owner=True):
-            if obj.is_prefix():  # 判断obj为文件夹。
-                pureName = obj.key[:obj.key.rfind('/')].replace(path, '')
-                d += [[pureName, obj.key]]
-                # print(i + 'd: ' + pureName)
+    def fetchDirectory(self):
+        # 不使用delimiter，一次性列出所有对象再在本地计算目录结构，这样每1000个对象只需要一次请求
+        entries = []
+        for obj in oss2.ObjectIteratorV2(self.bucket, max_keys=1000):
+            info = None if obj.key.endswith('/') else {'length': obj.size, 'hash': '', 'etag': obj.etag.strip('"')}
+            entries.append((obj.key, info))
+            if len(entries) % 10000 == 0:
+                print(f'已获取 {len(entries)} 个对象')
 
-            else:  # 判断obj为文件。
-                if obj.key == path:
-                    continue
-
-                pureName = obj.key[obj.key.rfind('/') + 1:]
-                # print(i + 'f: ' + pureName)
-
-                # 因为本地没有缓存文件，所以用不上这段代码
-                # if path + pureName == '/' + self.cacheFileName:
-                #     continue
-
-                # headers = self.bucket.head_object(obj.key).headers
-                # hash = headers['x-oss-meta-hash'] if 'x-oss-meta-hash' in headers else ''
-                directory.append({
-                    'name': pureName,
-                    'length': 0,
-                    'hash': ''
-                    # 'length': headers['Content-Length'],
-                    # 'hash': hash
-                })
-
-        for D in d:
-            # print(i+'D: '+D[0])
-            directory.append({
-                'name': D[0],
-                'children': self.fetchDirectory(D[1], i + '    ')
-            })
-
-        return directory
+        return keys_to_structure(entries)
 
     def fetchAll(self):
         if self.exists(self.cacheFileName):
@@ -83,14 +75,38 @@ class AliyunOSS(AbstractServiceProvider):
             print('缓存已找到 ' + self.cacheFileName)
             return self.cache
 
+        # 没有缓存时使用列出的大小和ETag对比文件，对比结束后需要重新生成缓存
+        self.modified = True
         return self.fetchDirectory()
 
     def fetchFragments(self):
-        result = []
+        uploads = {}  # key -> [(开始时间, UploadId)]，同一个文件可能有多次未完成的分片上传
+        maxAge = self.uploadTool.config.get('fragment_max_age', 72) * 3600
         for upload_info in oss2.MultipartUploadIterator(self.bucket):
-            result += [upload_info.key]
-            # self.fragments += [upload_info.key, upload_info.upload_id]
-        return result
+            if time.time() - upload_info.initiation_date > maxAge:
+                # 过期的碎片不再续传，直接清理掉，避免一直占用存储空间
+                print('清理过期的文件碎片: ' + upload_info.key)
+                self.bucket.abort_multipart_upload(upload_info.key, upload_info.upload_id)
+            else:
+                uploads.setdefault(upload_info.key, []).append((upload_info.initiation_date, upload_info.upload_id))
+
+        for key, candidates in uploads.items():
+            # resumable_upload只会续传断点记录里的那一次，没有记录时保留最新的，其余的不会再用到，清理掉
+            candidates.sort()
+            resumed = self.checkpointUploadId(key)
+            if resumed not in [uploadId for initiated, uploadId in candidates]:
+                resumed = candidates[-1][1]
+            for initiated, uploadId in candidates:
+                if uploadId != resumed:
+                    print('清理重复的文件碎片: ' + key)
+                    self.bucket.abort_multipart_upload(key, uploadId)
+        return list(uploads.keys())
+
+    def checkpointUploadId(self, key):
+        """resumable_upload的断点记录中这个文件正在续传的UploadId，没有记录时返回None"""
+        localPath = os.path.abspath(self.rootDir(key).path)
+        record = self.resumableStore.get(self.resumableStore.make_store_key(self.bucket.bucket_name, key, localPath))
+        return record.get('upload_id') if record is not None else None
 
     def deleteObjects(self, paths):
         def del_(paths_):
@@ -116,9 +132,22 @@ class AliyunOSS(AbstractServiceProvider):
         if self.uploadTool.debugMode and len(headers) > 0:
             print(headers)
 
-        oss2.resumable_upload(self.bucket, path, localPath, num_threads=4, headers=headers)
+        # 仅仅将上传添加到队列，等到下一步再使用多线程上传
+        self.addUploadTask({
+            "key": path,
+            "local": localPath,
+            "length": length,
+            "headers": headers
+        }, length, path)
         self.modified = True
 
+    def uploadWorker(self, task):
+        if task["length"] >= self.multipartThreshold:
+            return oss2.resumable_upload(self.bucket, task["key"], task["local"], store=self.resumableStore,
+                                         headers=task["headers"], multipart_threshold=self.multipartThreshold,
+                                         num_threads=self.partThreads)
+        return self.bucket.put_object_from_file(task["key"], task["local"], headers=task["headers"])
+
     def downloadObject(self, path):
         buf = BufferedRandom(BytesIO())
         for chunk in self.bucket.get_object(path):
@@ -135,16 +164,20 @@ class AliyunOSS(AbstractServiceProvider):
         return self.bucket.object_exists(path)
 
     def cleanup(self):
+        # 有文件上传失败时不能更新缓存，否则下次上传时会认为这些文件已经存在
+        if len(self.uploadFailures) > 0:
+            print('有文件上传失败，跳过更新缓存')
+            return
+
         # 实际上传文件之后，需要更新缓存文件
         if self.modified:
             print('正在更新缓存...')
-            cache = dir_hash(self.rootDir)
 
             if self.exists(self.cacheFileName):
                 self.deleteObjects([self.cacheFileName])
 
             # cacheContent = yaml.safe_dump(cache, sort_keys=False, canonical=True).encode('utf-8')
-            cacheContent = json.dumps(cache, ensure_ascii=False)
+            cacheContent = self.uploadTool.snapshot.document
             self.bucket.put_object(key=self.cacheFileName, data=cacheContent)
 
             print('缓存已更新 ' + self.cacheFileName)
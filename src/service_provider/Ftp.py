@@ -1,23 +1,26 @@
 import calendar
 import io
-import json
 import os
 import ssl
 import time
-from ftplib import FTP as _FTP, FTP_TLS
+from ftplib import FTP as _FTP, FTP_TLS, error_perm, error_temp
 from io import BufferedRandom
+from queue import Queue
+from threading import Lock
 
 import yaml
 
-from src.service_provider.AbstractServiceProvider import AbstractServiceProvider
-from src.utilities.dir_hash import dir_hash
+from src.service_provider.ParallelUploadServiceProvider import ParallelUploadServiceProvider
 from src.utilities.file import File
 from src.utilities.file_comparer import SimpleFileObject
 from src.utilities.glue import glue
+from src.utilities.hash_algorithms import load_structure
+from src.utilities.remote_delete import delete_deepest_first
+from src.utilities.remote_walker import walk_remote
 
 
 class FtpFileObject:
-    def __init__(self, name: str, length: int, modified: int):
+    def __init__(self, name: str, length: int, modified: int = None):
         self.name = name
         self.modified = modified
         self.length = length
@@ -35,32 +38,57 @@ class FtpClient:
         self.passwd = passwd
         self.secure = secure
         self.prot_p = prot_p
+        self.timeout = 5000
+        self.ftp = self.createFtp()
 
-        if secure:
+    def createFtp(self):
+        if self.secure:
             context = ssl.SSLContext()
             context.check_hostname = False
             context.verify_mode = ssl.CERT_NONE
 
-            self.ftp = FTP_TLS(context=context)
+            ftp = FTP_TLS(context=context)
         else:
-            self.ftp = _FTP()
-        self.ftp.encoding = "utf-8"
-
-    def open(self, timeout=5000):
-        print(f"connect to {self.host}:{self.port}")
+            ftp = _FTP()
+        ftp.encoding = "utf-8"
+        return ftp
+
+    def open(self, timeout=5000, verbose=True):
+        self.timeout = timeout
+        if verbose:
+            print(f"connect to {self.host}:{self.port}")
         self.ftp.connect(self.host, self.port, timeout=timeout)
         self.ftp.login(self.user, self.passwd)
 
         if self.secure and self.prot_p:
             self.ftp.prot_p()
 
-        print(f'\n------来自{self.host}:{self.port}的消息------')
-        print(self.ftp.getwelcome())
-        print('')
+        if verbose:
+            print(f'\n------来自{self.host}:{self.port}的消息------')
+            print(self.ftp.getwelcome())
+            print('')
 
-    def close(self):
+    def close(self, verbose=True):
         self.ftp.close()
-        print(f"disconnected from {self.host}:{self.port}")
+        if verbose:
+            print(f"disconnected from {self.host}:{self.port}")
+
+    def reconnect(self):
+        """断开并重新建立连接(连接超时或被服务器断开后使用)"""
+        try:
+            self.ftp.close()
+        except Exception:
+            pass
+        self.ftp = self.createFtp()
+        self.open(self.timeout, verbose=False)
+
+    def run(self, func):
+        """执行func(self)，连接已经断开或超时(比如421)的话重连后再执行一次"""
+        try:
+            return func(self)
+        except (EOFError, OSError, error_temp):
+            self.reconnect()
+            return func(self)
 
     def uploadFile(self, file: File, path: str):
         if not file.exists:
@@ -90,21 +118,37 @@ class FtpClient:
 
         return buf.read().decode(encoding)
 
-    def deleteFile(self, path: str):
-        self.ftp.delete(path)
+    def deleteFile(self, path: str, missingOk=False):
+        """:param missingOk: 文件已经不存在时(比如上次运行删除后没能更新缓存)不报错"""
+        self.removeIfPresent(self.ftp.delete, path, missingOk)
+
+    def deleteDirectory(self, path: str, missingOk=False):
+        """:param missingOk: 目录已经不存在时不报错"""
+        self.removeIfPresent(self.ftp.rmd, path, missingOk)
 
-    def deleteDirectory(self, path: str):
-        self.ftp.rmd(path)
+    def removeIfPresent(self, remove, path: str, missingOk: bool):
+        try:
+            remove(path)
+        except error_perm as e:
+            # 550 也可能是权限不足或目录非空，确认确实不存在了才忽略
+            if not missingOk or not str(e).startswith('550') or self.exists(path):
+                raise
+            print(f'远程已不存在，跳过删除: {path}')
 
     def listFiles(self, path=''):
         """列出详细文件信息"""
         files = []
-        for f in self.mlsd(path):
-            isFile = f[1]['type'] == 'file'
+        for name, facts in self.mlsd(path):
+            # 跳过 . 和 .. (cdir/pdir) 以及其它类型的条目
+            if facts.get('type') not in ('file', 'dir'):
+                continue
+            isFile = facts['type'] == 'file'
+            # modify 是UTC时间 YYYYMMDDHHMMSS[.sss]，转换为与本地快照相同的时间戳(秒)
+            modify = facts.get('modify')
             files += [FtpFileObject(**{
-                'name': f[0],
-                'length': int(f[1]['size']) if isFile else -1,
-                'modified': int(f[1]['modify'])
+                'name': name,
+                'length': int(facts.get('size', 0)) if isFile else -1,
+                'modified': calendar.timegm(time.strptime(modify[:14], '%Y%m%d%H%M%S')) if modify else None
             })]
         return files
 
@@ -113,7 +157,13 @@ class FtpClient:
             path = path[:-1]
         basename = os.path.basename(path)
         dirname = os.path.dirname(path)
-        return basename in [os.path.basename(f) for f in self.nlst(dirname)]
+        try:
+            return basename in [os.path.basename(f) for f in self.nlst(dirname)]
+        except error_perm as e:
+            # 上级目录不存在
+            if str(e).startswith('550'):
+                return False
+            raise
 
     # 低级API
 
@@ -145,13 +195,53 @@ class FtpClient:
         self.close()
 
 
-class Ftp(AbstractServiceProvider):
+class FtpClientPool:
+    """FTP连接池，连接在多个文件之间复用，断开或超时后自动重连"""
+
+    def __init__(self, factory, size: int):
+        self.factory = factory  # 创建FtpClient的函数
+        self.size = size
+        self.idle = Queue()
+        self.clients = []
+        self.lock = Lock()
+
+    def acquire(self):
+        with self.lock:
+            if self.idle.empty() and len(self.clients) < self.size:
+                client = self.factory()
+                client.open(verbose=False)
+                self.clients.append(client)
+                return client
+        return self.idle.get()
+
+    def release(self, client: FtpClient):
+        self.idle.put(client)
+
+    def run(self, func):
+        """使用一个空闲连接执行func(client)，连接已经断开或超时的话重连后再执行一次"""
+        client = self.acquire()
+        try:
+            return client.run(func)
+        finally:
+            self.release(client)
+
+    def close(self):
+        for client in self.clients:
+            try:
+                client.close(verbose=False)
+            except Exception:
+                pass
+        self.clients = []
+
+
+class Ftp(ParallelUploadServiceProvider):
     def __init__(self, uploadTool, config):
         super(Ftp, self).__init__(uploadTool, config)
 
         self.cache = []  # 缓存的远程文件结构
         self.modified = False  # 是否有过上传行为
         self.rootDir: File = None  # 本地根目录
+        self.knownDirectories = set()  # 本次运行中已知存在的远程目录(相对basePath，''表示basePath本身)
 
         self.host = config['host']
         self.port = config['port']
@@ -165,7 +255,12 @@ class Ftp(AbstractServiceProvider):
         # 补上末尾的/
         self.basePath = self.basePath + '/' if not self.basePath.endswith('/') else self.basePath
 
+        # 主连接在计算校验和并行上传期间一直空闲，可能会被服务器超时断开，所以打开之后的操作都要通过self.ftp.run()执行
         self.ftp = FtpClient(self.host, self.port, self.user, self.passwd, self.secure, self.prot_p)
+        # 上传、列目录和删除使用的连接池
+        self.connections = config.get('connections', 4)
+        self.pool = FtpClientPool(
+            lambda: FtpClient(self.host, self.port, self.user, self.passwd, self.secure, self.prot_p), self.connections)
 
     def initialize(self, rootDir: File):
         self.rootDir = rootDir
@@ -174,86 +269,130 @@ class Ftp(AbstractServiceProvider):
         # 创建根目录
         if self.basePath != '/' and not self.ftp.exists(self.basePath):
             self.ftp.mkdir(self.basePath)
-
-    def fetchDirectory(self, path='/'):
-        self.ftp.cd(self.basePath + (path[1:] if path.startswith('/') else path))
-        print(f"cd into: {self.ftp.pwd()}")
-
-        result = []
-
-        for fileObj in self.ftp.listFiles():
-            filename = fileObj.name
-            isFile = fileObj.isFile
-
-            if path + filename == '/' + self.cacheFileName:
-                continue
-
-            if isFile:
-                result += [{'name': filename, 'length': -1, 'hash': ''}]
-            else:
-                result += [{'name': filename, 'children': self.fetchDirectory(path + filename + '/')}]
-
-        return result
+        self.knownDirectories.add('')
+
+    def fetchDirectory(self):
+        """没有缓存时列出整个远程目录，多个连接同时列出不同的目录"""
+        def listdir(path):
+            # 直接对完整路径执行MLSD，不需要逐级cwd和pwd
+            files = self.pool.run(lambda client: client.listFiles(self.basePath + path))
+            print(f"listed: {self.basePath + path}")
+            self.knownDirectories.add(path.rstrip('/'))
+
+            result = []
+            for fileObj in files:
+                if path == '' and fileObj.name == self.cacheFileName:
+                    continue
+                if fileObj.isFile:
+                    result += [{'name': fileObj.name, 'length': fileObj.length, 'hash': '', 'modified': fileObj.modified}]
+                else:
+                    result += [{'name': fileObj.name, 'children': []}]
+            return result
+
+        return walk_remote(listdir, self.connections)
 
     def fetchAll(self):
-        if self.ftp.exists(self.basePath + self.cacheFileName):
-            self.cache = yaml.safe_load(self.ftp.downloadAsText(self.basePath + self.cacheFileName))
+        if self.ftp.run(lambda client: client.exists(self.basePath + self.cacheFileName)):
+            self.cache = yaml.safe_load(self.ftp.run(lambda client: client.downloadAsText(self.basePath + self.cacheFileName)))
             print('缓存已找到 '+self.cacheFileName)
+            self.learnDirectories(load_structure(self.cache)[0])
             return self.cache
 
         return self.fetchDirectory()
 
     def deleteObjects(self, paths):
-        for f in paths:
-            self.ftp.deleteFile(self.basePath + f)
+        # 多个连接同时删除
+        delete_deepest_first(paths, lambda f: self.pool.run(
+            lambda client: client.deleteFile(self.basePath + f, True)), self.connections)
         self.modified = True
 
     def deleteDirectories(self, paths):
-        for f in paths:
-            self.ftp.deleteDirectory(self.basePath + f)
+        def remove(f):
+            self.pool.run(lambda client: client.deleteDirectory(self.basePath + f, True))
+            self.knownDirectories.discard(f)
+
+        # 从最深的目录开始删，保证删除一个目录时它的子目录都已经删掉了
+        delete_deepest_first(paths, remove, self.connections)
         self.modified = True
 
+    def learnDirectories(self, structure: list, parent=''):
+        """把缓存中记录的目录都标记为已存在，上传时就不用逐级检查了"""
+        for f in structure:
+            if 'children' in f:
+                path = parent + f['name']
+                self.knownDirectories.add(path)
+                self.learnDirectories(f['children'], path + '/')
+
+    def ensureDirectory(self, path):
+        """确保远程目录存在，只对本次运行中还不知道是否存在的目录发起请求"""
+        if path in self.knownDirectories:
+            return
+        if not self.ftp.run(lambda client: client.exists(self.basePath + path)):
+            print('mkdir: ' + path)
+            self.ftp.run(lambda client: client.mkdir(self.basePath + path))
+        self.knownDirectories.add(path)
+
     def uploadObject(self, path, localPath, baseDir, length, hash):
         localFile = File(localPath)
 
         layers = path.split('/')
-        _layers = [''] + [
-            glue(layers[:level + 1], '/')
-            for level in range(0, len(layers) - 1)
-        ]
-
-        for i in range(0, len(_layers) - 1):
-            parent = _layers[i]
-            child = _layers[i + 1]
-
-            # self.ftp.cd(self.basePath + parent)
-            if not self.ftp.exists(self.basePath + child):
-                print('mkdir: ' + child)
-                self.ftp.mkdir(self.basePath + child)
-
-        self.ftp.uploadFile(localFile, self.basePath + path)
+        for level in range(0, len(layers) - 1):
+            self.ensureDirectory(glue(layers[:level + 1], '/'))
+
+        # 目录在这里(主线程)创建好，上传交给连接池里的多个连接同时进行
+        self.addUploadTask({
+            "local": localFile,
+            "remote": self.basePath + path
+        }, length, path)
         self.modified = True
 
+    def uploadWorker(self, task):
+        def upload(client: FtpClient):
+            try:
+                client.uploadFile(task["local"], task["remote"])
+            except error_perm:
+                # 缓存里记录的目录可能已经在服务器上被删掉了，补建上级目录后再试一次
+                layers = task["remote"].split('/')
+                for level in range(len(self.basePath.rstrip('/').split('/')) + 1, len(layers)):
+                    try:
+                        client.mkdir(glue(layers[:level], '/'))
+                    except error_perm:
+                        pass
+                client.uploadFile(task["local"], task["remote"])
+
+        return self.pool.run(upload)
+
+    def startParallelUploadWork(self, threads: int = 16, batches=None, baseDir=None):
+        # 线程数不超过连接数，多出来的线程只会等待空闲连接
+        super(Ftp, self).startParallelUploadWork(min(threads, self.connections), batches, baseDir)
+
     def makeDirectory(self, path):
-        if not self.ftp.exists(self.basePath + path):
-            self.ftp.mkdir(self.basePath + path)
+        self.ensureDirectory(path)
         self.modified = True
 
     def cleanup(self):
-        # 实际上传文件之后，需要更新缓存文件
-        if self.modified:
+        self.pool.close()
+
+        # 实际上传文件之后，需要更新缓存文件(有文件上传失败时不能更新，否则下次上传时会认为这些文件已经存在)
+        if len(self.uploadFailures) > 0:
+            print('有文件上传失败，跳过更新缓存')
+        elif self.modified:
             print('正在更新缓存...')
-            cache = dir_hash(self.rootDir)
 
-            if self.ftp.exists(self.basePath + self.cacheFileName):
-                self.ftp.deleteFile(self.basePath + self.cacheFileName)
+            if self.ftp.run(lambda client: client.exists(self.basePath + self.cacheFileName)):
+                self.ftp.run(lambda client: client.deleteFile(self.basePath + self.cacheFileName, True))
 
             buf = BufferedRandom(io.BytesIO())
             # buf.write(yaml.safe_dump(cache, sort_keys=False, canonical=True).encode('utf-8'))
-            cacheContent = json.dumps(cache, ensure_ascii=False)
-            buf.write(cacheContent)
-            buf.seek(0)
-            self.ftp.uploadBinary(buf, self.basePath + self.cacheFileName)
+            cacheContent = self.uploadTool.snapshot.document
+            buf.write(cacheContent.encode('utf-8'))
+
+            def upload(client: FtpClient):
+                # 重连后重新上传时要从头读取
+                buf.seek(0)
+                client.uploadBinary(buf, self.basePath + self.cacheFileName)
+
+            self.ftp.run(upload)
 
             print('缓存已更新 '+self.cacheFileName)
 
@@ -1,54 +1,250 @@
+import random
 import time
-from threading import Thread
+import traceback
+from threading import Thread, Condition
 from abc import abstractmethod
 from queue import Queue
 
 from src.service_provider.AbstractServiceProvider import AbstractServiceProvider
 
 class ParallelUploadServiceProvider(AbstractServiceProvider):
+    concurrencyControlInterval = 3.0  # 自适应并发控制的采样周期(秒)
+
     def __init__(self, uploadTool, config):
         super(ParallelUploadServiceProvider, self).__init__(uploadTool, config)
         self.uploadTaskTotal: int = 0
+        self.uploadTaskBytes: int = 0
         self.uploadTaskStartAt: float = 0.0
         self.uploadInboundQueue: Queue = Queue()
         self.uploadOutboundQueue: Queue = Queue()
 
-    def startParallelUploadWork(self, threads: int = 16):
-        """执行并行上传"""
+        # 以下状态均由uploadCondition保护，工作线程完成任务时通过它通知主线程刷新进度
+        self.uploadCondition = Condition()
+        self.uploadFinished: int = 0
+        self.uploadFinishedBytes: int = 0
+        self.uploadWorkerStates = {}  # 线程编号 -> (文件名, 开始时间)，空闲时为None
+        self.progressWidth: int = 0  # 上一次输出的进度长度，用来覆盖掉残留的字符
+        self.uploadFailures = []  # 重试之后仍然上传失败的任务：(文件名, 异常)
+        self.uploadErrors: int = 0  # 上传出错的次数(包括之后重试成功的)，用于自适应并发控制
+        self.uploadConcurrency: int = 0  # 当前允许同时工作的线程数，编号不小于这个值的线程会暂停
+        self.uploadBatch = None  # uploadObjects()执行期间收集的同一批任务
+        self.uploadProducing = False  # 流水线模式下是否还在产出新的任务
+        self.uploadProducerError = None  # 流水线模式下产出任务时出现的异常
+
+    def addUploadTask(self, task, length: int, name: str):
+        """添加一个上传任务，等到startParallelUploadWork()时再并行上传
+        :param task: 交给uploadWorker()的参数
+        :param length: 文件大小，用于计算上传速度
+        :param name: 显示在进度里的文件名
+        """
+        if self.uploadBatch is not None:
+            self.uploadBatch.append((task, length, name))
+        else:
+            self.uploadInboundQueue.put([(task, length, name)])
+        self.uploadTaskTotal += 1
+        self.uploadTaskBytes += length
+
+    def uploadObjects(self, files: list, baseDir):
+        # 同一批文件作为一个队列项，由同一个工作线程依次上传
+        self.uploadBatch = []
+        try:
+            super(ParallelUploadServiceProvider, self).uploadObjects(files, baseDir)
+        finally:
+            batch, self.uploadBatch = self.uploadBatch, None
+        if len(batch) > 0:
+            self.uploadInboundQueue.put(batch)
+
+    def startParallelUploadWork(self, threads: int = 16, batches=None, baseDir=None):
+        """执行并行上传
+        :param threads: 最大线程数，开启自适应并发(upload_adaptive)时实际并发数会在1到这个值之间调整
+        :param batches: 流水线模式下的任务来源，产出[(相对路径, 本地路径, 文件大小, 文件校验)]批次的可迭代对象，
+                        会在单独的线程中一边产出一边交给uploadObjects()，队列满时暂停产出；
+                        为None时只上传之前已经添加好的任务
+        :param baseDir: 流水线模式下传给uploadObjects()的baseDir
+        """
+        interval = self.uploadTool.config.get('progress_interval', 0.5)
+        adaptive = self.uploadTool.config.get('upload_adaptive', True)
         self.uploadTaskStartAt = time.time()
-        self.uploadTaskTotal = self.uploadInboundQueue.qsize()
+        self.uploadConcurrency = min(4, threads) if adaptive else threads
+        if batches is not None:
+            self.uploadInboundQueue = Queue(threads * 2)
+            self.uploadProducing = True
+            Thread(target=self.produceUploadTasks, args=(batches, baseDir), daemon=True).start()
         for i in range(threads):
-            Thread(target=self.uploadWorkerThreadLoop, args=(), daemon=True).start()
-        self.printProgress(0)
-        while self.uploadOutboundQueue.qsize() < self.uploadTaskTotal:
-            self.printProgress(self.uploadOutboundQueue.qsize())
-        self.printProgress(self.uploadTaskTotal)
+            self.uploadWorkerStates[i] = None
+            Thread(target=self.uploadWorkerThreadLoop, args=(i,), daemon=True).start()
+        with self.uploadCondition:
+            controller = ConcurrencyController(self, threads) if adaptive else None
+            self.printProgress()
+            while not self.uploadCondition.wait_for(
+                    lambda: not self.uploadProducing and self.uploadFinished >= self.uploadTaskTotal, interval):
+                if controller is not None:
+                    controller.update()
+                self.printProgress()
+            self.printProgress()
         print("\n请等待最后一个文件上传结束...")
         self.uploadInboundQueue.join()
-        print("并行上传完成")
+        if self.uploadProducerError is not None:
+            raise self.uploadProducerError
+        if len(self.uploadFailures) > 0:
+            print(f"并行上传完成，有{len(self.uploadFailures)}个文件上传失败：")
+            for name, error in self.uploadFailures:
+                print(f"  {name}: {error!r}")
+        else:
+            print("并行上传完成")
         # self.uploadOutboundQueue.join()
 
-    def uploadWorkerThreadLoop(self):
+    def produceUploadTasks(self, batches, baseDir):
+        """流水线模式下产出上传任务的线程函数"""
+        try:
+            for files in batches:
+                self.uploadObjects(files, baseDir)
+        except BaseException as e:
+            self.uploadProducerError = e
+        finally:
+            with self.uploadCondition:
+                self.uploadProducing = False
+                self.uploadCondition.notify_all()
+
+    def uploadWorkerThreadLoop(self, index: int):
+        retries = self.uploadTool.config.get('upload_retries', 3)
         while True:
-            task = self.uploadInboundQueue.get()
-            result = self.uploadWorker(task)
-            self.uploadOutboundQueue.put(result)
-            self.uploadInboundQueue.task_done()
+            with self.uploadCondition:
+                self.uploadCondition.wait_for(lambda: index < self.uploadConcurrency)
+            batch = self.uploadInboundQueue.get()
+            try:
+                for task, length, name in batch:
+                    self.runUploadTask(index, task, length, name, retries)
+            finally:
+                # 无论成功与否都要调用task_done()，否则主线程会永远等待下去
+                self.uploadInboundQueue.task_done()
+
+    def runUploadTask(self, index: int, task, length: int, name: str, retries: int):
+        """执行单个上传任务，失败时记录到uploadFailures而不是抛出异常"""
+        with self.uploadCondition:
+            self.uploadWorkerStates[index] = (name, time.time())
+        try:
+            self.uploadOutboundQueue.put(self.uploadWithRetry(task, name, retries))
+        except Exception as e:
+            if self.uploadTool.debugMode:
+                print(traceback.format_exc())
+            with self.uploadCondition:
+                self.uploadFailures.append((name, e))
+        finally:
+            with self.uploadCondition:
+                self.uploadWorkerStates[index] = None
+                self.uploadFinished += 1
+                self.uploadFinishedBytes += length
+                self.uploadCondition.notify_all()
+
+    def uploadWithRetry(self, task, name: str, retries: int):
+        """执行上传任务，失败时按指数退避(带随机抖动)重试，重试次数用完后抛出最后一次的异常"""
+        for attempt in range(retries + 1):
+            try:
+                return self.uploadWorker(task)
+            except Exception as e:
+                with self.uploadCondition:
+                    self.uploadErrors += 1
+                if attempt == retries:
+                    raise
+                delay = min(2 ** attempt, 30) * random.uniform(0.5, 1.5)
+                if self.uploadTool.debugMode:
+                    print(f"\n上传失败，{delay:.1f}秒后重试({attempt + 1}/{retries}): {name}: {e!r}")
+                time.sleep(delay)
 
     @abstractmethod
     def uploadWorker(self, task):
         """并行上传的工作线程函数，必须通过队列传递参数"""
         pass
 
-    def printProgress(self, finished: int):
-        """输出多线程工作进度"""
-        duration = int(time.time() - self.uploadTaskStartAt)
+    def printProgress(self):
+        """输出多线程工作进度，调用时需要持有uploadCondition"""
+        now = time.time()
+        duration = int(now - self.uploadTaskStartAt)
         seconds = duration % 60
         minutes = duration // 60
+        finished = self.uploadFinished
         total = self.uploadTaskTotal
-        pct = finished / total
+        pct = finished / total if total > 0 else 1
         bar = f"[{'=' * int(pct * 20 - 1) + '>':<20}]"
-        spaces = " " * (len(str(total)) * 2)
-        if (total - finished) <= 16:
-            spaces = "没有卡住，马上就好" + spaces
-        print(f"正在多线程上传：{finished}/{total} {bar} {pct:.1%} {minutes}:{seconds:02d}", spaces, end="\r", flush=True)
+
+        speed = self.uploadFinishedBytes / max(now - self.uploadTaskStartAt, 0.001)
+        remaining = self.uploadTaskBytes - self.uploadFinishedBytes
+        eta = int(remaining / speed) if speed > 0 else 0
+        busy = [state for state in self.uploadWorkerStates.values() if state is not None]
+
+        status = f"{formatSize(speed)}/s 剩余{eta // 60}:{eta % 60:02d} 线程{len(busy)}/{self.uploadConcurrency}"
+        if self.uploadProducing:
+            # 流水线模式下总数还在增加
+            total = f"{total}+"
+        elif 0 < total - finished <= len(self.uploadWorkerStates) and len(busy) > 0:
+            # 只剩最后几个文件时，显示耗时最长的那个，避免看起来像是卡住了
+            name, startAt = min(busy, key=lambda s: s[1])
+            status += f" 没有卡住，正在上传 {name} ({int(now - startAt)}s)"
+        line = f"正在多线程上传：{finished}/{total} {bar} {pct:.1%} {minutes}:{seconds:02d} {status}"
+        print(line.ljust(self.progressWidth), end="\r", flush=True)
+        self.progressWidth = len(line)
+
+
+class ConcurrencyController:
+    """AIMD自适应并发控制
+
+    每个采样周期根据吞吐量和出错次数调整并发数：出错(包括被限流)时减半；
+    上次增加并发后吞吐量明显下降时退回；所有线程都在工作且还有任务排队时加一
+    """
+
+    def __init__(self, provider: ParallelUploadServiceProvider, ceiling: int):
+        self.provider = provider
+        self.ceiling = ceiling
+        self.lastControlAt = time.time()
+        self.lastBytes = 0
+        self.lastFinished = 0
+        self.lastErrors = 0
+        self.lastThroughput = 0.0
+        self.lastIncreased = False
+
+    def update(self):
+        """采样并调整并发数，调用时需要持有uploadCondition"""
+        p = self.provider
+        now = time.time()
+        if now - self.lastControlAt < p.concurrencyControlInterval:
+            return
+
+        throughput = (p.uploadFinishedBytes - self.lastBytes) / (now - self.lastControlAt)
+        finished = p.uploadFinished - self.lastFinished
+        errors = p.uploadErrors - self.lastErrors
+        busy = len([state for state in p.uploadWorkerStates.values() if state is not None])
+        old = p.uploadConcurrency
+
+        if errors > 0:
+            p.uploadConcurrency = max(1, old // 2)
+            reason = f'出现{errors}次失败或限流'
+        elif self.lastIncreased and throughput < self.lastThroughput * 0.9:
+            p.uploadConcurrency = max(1, old - 1)
+            reason = '增加并发后吞吐量下降'
+        elif busy >= old and p.uploadInboundQueue.qsize() > 0:
+            p.uploadConcurrency = min(self.ceiling, old + 1)
+            reason = '线程已全部占满'
+        else:
+            reason = None
+
+        if p.uploadConcurrency != old:
+            print(f"\n并发数调整 {old} -> {p.uploadConcurrency}：{reason} "
+                  f"(吞吐量 {formatSize(throughput)}/s，完成 {finished} 个文件)")
+            p.uploadCondition.notify_all()
+
+        self.lastIncreased = p.uploadConcurrency > old
+        self.lastControlAt = now
+        self.lastBytes = p.uploadFinishedBytes
+        self.lastFinished = p.uploadFinished
+        self.lastErrors = p.uploadErrors
+        self.lastThroughput = throughput
+
+
+def formatSize(size: float):
+    """将字节数格式化为可读的大小"""
+    for unit in ['B', 'KB', 'MB', 'GB']:
+        if size < 1024:
+            return f"{size:.1f}{unit}"
+        size /= 1024
+    return f"{size:.1f}TB"
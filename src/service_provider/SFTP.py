@@ -1,14 +1,20 @@
+import errno
 import io
-import json
+import posixpath
+import shlex
+import shutil
 from io import BufferedRandom
+from queue import Queue
 from stat import S_ISDIR
+from threading import Lock
 
 import paramiko as paramiko
 import yaml
 
-from src.service_provider.AbstractServiceProvider import AbstractServiceProvider
-from src.utilities.dir_hash import dir_hash
+from src.service_provider.ParallelUploadServiceProvider import ParallelUploadServiceProvider
 from src.utilities.file import File
+from src.utilities.remote_delete import delete_deepest_first
+from src.utilities.remote_walker import walk_remote
 
 
 class SFTPClient:
@@ -19,30 +25,62 @@ class SFTPClient:
         self.usePkey = use_pkey
         self.pkeyFile = pkey_file
         self.password = password
+        self.blockSize = 1024 * 1024  # 上传时每次从本地文件读取的大小
 
-        self.transport = paramiko.Transport((host, int(port)))
+        self.transport = None
         self.sftp = None
+        self.cwd = None  # 工作目录，新建的通道和重连之后都会切换到这里
+        self.lock = Lock()
 
-    def open(self):
-        print(f"正在连接到 {self.host}:{self.port}...")
+    def open(self, verbose=True):
+        if verbose:
+            print(f"正在连接到 {self.host}:{self.port}...")
+        self.transport = paramiko.Transport((self.host, int(self.port)))
         # 自动添加远端主机到 known_hosts 中
         # 从 transport 实例创建似乎并不需要
         # self.ssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
         if self.usePkey:
-            print("使用公钥进行身份验证...")
+            if verbose:
+                print("使用公钥进行身份验证...")
             pkey = paramiko.RSAKey.from_private_key_file(self.pkeyFile, self.password)
             self.transport.connect(username=self.user, password=self.password, pkey=pkey)
         else:
-            print("使用密码进行身份验证...")
+            if verbose:
+                print("使用密码进行身份验证...")
             self.transport.connect(username=self.user, password=self.password)
         # 从 transport 实例创建 SFTP 客户端实例
         self.sftp = paramiko.SFTPClient.from_transport(self.transport)
-        print(f"已连接到 {self.host}:{self.port}.")
+        if self.cwd is not None:
+            self.sftp.chdir(self.cwd)
+        if verbose:
+            print(f"已连接到 {self.host}:{self.port}.")
 
     def close(self):
         self.transport.close()
         print(f"已从 {self.host}:{self.port} 断开.")
 
+    def open_channel(self):
+        """在同一个 transport 上再开一个 SFTP 通道，连接已经断开的话先重连"""
+        with self.lock:
+            if not self.transport.is_active():
+                self.open(verbose=False)
+            channel = paramiko.SFTPClient.from_transport(self.transport)
+        # 切换到工作目录之后，相对路径由 paramiko 在本地拼接，不再需要 normalize
+        if self.cwd is not None:
+            channel.chdir(self.cwd)
+        return channel
+
+    def put_file(self, channel: paramiko.SFTPClient, local_path: str, remote_path: str):
+        """通过指定通道上传文件
+
+        写请求以流水线方式连续发送，不逐块等待服务器确认，出错时会在关闭文件时抛出；
+        因此也省去了 put() 上传后再 stat 一次核对大小的往返
+        """
+        with open(local_path, 'rb') as src:
+            with channel.open(remote_path, 'wb', self.blockSize) as dst:
+                dst.set_pipelined(True)
+                shutil.copyfileobj(src, dst, self.blockSize)
+
     def upload_file(self, local_path_or_file_buf, remote_path: str, is_file_buf: bool):
         # 区分从缓冲区上传和从本地路径上传，其实可以用 isInstance() 判断参数类型
         if is_file_buf:
@@ -65,16 +103,22 @@ class SFTPClient:
         except Exception:
             print('删除失败，文件可能不存在')
 
-    def delete_directory(self, path: str):
-        try:
-            self.sftp.rmdir(self.abspath(path))
-        except Exception:
-            print('删除失败，目录可能不存在')
-        self.sftp.remove(self.abspath(path))
-
     def delete_directory(self, path: str):
         self.sftp.rmdir(self.abspath(path))
 
+    def exec_command(self, command: str):
+        """通过 exec 通道在服务器上执行命令
+        :return: (退出码, 输出)
+        """
+        channel = self.transport.open_session()
+        try:
+            channel.set_combine_stderr(True)
+            channel.exec_command(command)
+            output = channel.makefile('rb').read()
+            return channel.recv_exit_status(), output.decode('utf-8', 'replace')
+        finally:
+            channel.close()
+
     def list_files(self, path: str):
         # 读取文件列表（包含文件描述符，用于快速判断是否为目录）
         return self.sftp.listdir_attr(self.abspath(path))
@@ -82,16 +126,74 @@ class SFTPClient:
     # 设置工作目录
     def swd(self, path: str):
         self.sftp.chdir(self.abspath(path))
+        self.cwd = self.sftp.getcwd()
 
     def create_directory(self, path: str):
-        self.sftp.mkdir(path, 0o755)
+        try:
+            self.sftp.mkdir(path, 0o755)
+        except IOError as e:
+            # 目录已经存在(比如上次运行创建后没能更新缓存)时跳过，其它错误照常抛出
+            try:
+                is_directory = S_ISDIR(self.sftp.stat(path).st_mode)
+            except IOError:
+                is_directory = False
+            if not is_directory:
+                raise e
 
     # 处理相对路径为绝对路径，避免问题
     def abspath(self, path: str):
         return self.sftp.normalize(path)
 
 
-class SFTP(AbstractServiceProvider):
+class SFTPChannelPool:
+    """SFTP 通道池，所有通道复用同一个 transport，在多个文件之间复用，断开后自动重开"""
+
+    def __init__(self, client: SFTPClient, size: int):
+        self.client = client
+        self.size = size
+        self.idle = Queue()
+        self.channels = []
+        self.lock = Lock()
+
+    def acquire(self):
+        with self.lock:
+            if self.idle.empty() and len(self.channels) < self.size:
+                channel = self.client.open_channel()
+                self.channels.append(channel)
+                return channel
+        return self.idle.get()
+
+    def release(self, channel: paramiko.SFTPClient):
+        self.idle.put(channel)
+
+    def run(self, func):
+        """使用一个空闲通道执行func(channel)，通道已经断开的话重开后再执行一次"""
+        channel = self.acquire()
+        try:
+            try:
+                return func(channel)
+            except (EOFError, OSError, paramiko.SSHException):
+                # 服务器返回的错误(比如权限不足)也是 IOError，通道还能用的话直接抛出
+                if not channel.get_channel().closed:
+                    raise
+                replacement = self.client.open_channel()
+                with self.lock:
+                    self.channels[self.channels.index(channel)] = replacement
+                channel = replacement
+                return func(channel)
+        finally:
+            self.release(channel)
+
+    def close(self):
+        for channel in self.channels:
+            try:
+                channel.close()
+            except Exception:
+                pass
+        self.channels = []
+
+
+class SFTP(ParallelUploadServiceProvider):
     def __init__(self, upload_tool, config):
         super(SFTP, self).__init__(upload_tool, config)
 
@@ -106,9 +208,16 @@ class SFTP(AbstractServiceProvider):
         self.pkeyFile = config['pkeyFile']
         self.passwd = config['password']
         self.basePath = config['basePath']
-        self.cacheFileName = config['cacheFile']
+        # 示例配置中写的是 cache_file，兼容旧的 cacheFile
+        self.cacheFileName = config.get('cache_file', config.get('cacheFile'))
 
         self.sftp = SFTPClient(self.host, self.port, self.user, self.usePkey, self.pkeyFile, self.passwd)
+        # 上传专用的通道池，列目录、删除等操作仍然使用上面的通道
+        self.connections = config.get('connections', 4)
+        self.pool = SFTPChannelPool(self.sftp, self.connections)
+        # 通过 rm -rf 在服务器上直接删除，需要账号允许执行命令
+        self.fastDelete = config.get('fast_delete', False)
+        self.commandLength = 64 * 1024  # 一条删除命令的最大长度，超过之后分成多条
 
     def initialize(self, root_dir: File):
         self.rootDir = root_dir
@@ -120,23 +229,24 @@ class SFTP(AbstractServiceProvider):
             self.sftp.create_directory(self.basePath)
         self.sftp.swd(self.basePath)
 
-    def list_recursively(self, path='.'):
-        # 保存所有文件的列表
-        result = []
+    def list_recursively(self):
+        # 多个通道同时列出不同的目录，路径都是相对于 basePath 在本地拼接的，不需要 normalize
+        def listdir(path):
+            # 获取指定目录下的所有目录及文件，包含属性值
+            entries = self.pool.run(lambda channel: channel.listdir_attr(path or '.'))
+            result = []
+            for entry in entries:
+                filename = entry.filename
+                # 忽略缓存文件
+                if path == '' and filename == self.cacheFileName:
+                    continue
+                if S_ISDIR(entry.st_mode):
+                    result.append({'name': filename, 'children': []})
+                else:
+                    result.append({'name': filename, 'length': entry.st_size, 'hash': '', 'modified': entry.st_mtime})
+            return result
 
-        # 获取当前指定目录下的所有目录及文件，包含属性值
-        for entry in self.sftp.list_files(path):
-            filename = entry.filename
-            full_path = self.sftp.abspath(f"{path}/{filename}")
-            # 忽略缓存文件
-            if full_path == self.sftp.abspath(self.cacheFileName):
-                continue
-            # 如果是目录，则添加并递归处理该目录
-            if S_ISDIR(entry.st_mode):
-                result.append({'name': filename, 'children': self.list_recursively(full_path)})
-            else:
-                result.append({'name': filename, 'length': -1, 'hash': ''})
-        return result
+        return walk_remote(listdir, self.connections)
 
     def fetchAll(self):
         # 尝试读取缓存
@@ -149,27 +259,104 @@ class SFTP(AbstractServiceProvider):
             return self.list_recursively()
 
     def deleteObjects(self, files):
-        for file in files:
-            self.sftp.delete_file(file)
+        if self.fastDelete:
+            files = self.remove_remotely(files)
+
+        def remove(channel, file):
+            try:
+                channel.remove(file)
+            except IOError:
+                print(f'删除失败，文件可能不存在: {file}')
+
+        # 多个通道同时删除
+        delete_deepest_first(files, lambda f: self.pool.run(lambda channel: remove(channel, f)), self.connections)
         self.modified = True
 
     def deleteDirectories(self, paths):
-        for path in paths:
-            self.sftp.delete_directory(path)
+        if self.fastDelete:
+            paths = self.remove_remotely(paths)
+
+        def remove(channel, path):
+            try:
+                channel.rmdir(path)
+            except IOError as e:
+                # 目录已经不存在(比如上次运行删除后没能更新缓存)时跳过，其它错误(比如目录非空)照常抛出
+                if e.errno != errno.ENOENT:
+                    raise
+                print(f'远程已不存在，跳过删除: {path}/')
+
+        # 从最深的目录开始删，保证删除一个目录时它的子目录都已经删掉了
+        delete_deepest_first(paths, lambda p: self.pool.run(lambda channel: remove(channel, p)), self.connections)
         self.modified = True
 
+    def confine(self, path: str):
+        """把相对路径转换为服务器上的绝对路径，并确保它位于 basePath 之内(不能是 basePath 本身)"""
+        base = self.sftp.cwd
+        full = posixpath.normpath(posixpath.join(base, path))
+        if full == base or not full.startswith(base.rstrip('/') + '/'):
+            raise ValueError(f"'{path}' is outside of the base path '{base}'")
+        return full
+
+    def remove_remotely(self, paths):
+        """在服务器上用 rm -rf 批量删除文件/目录，已经被上层目录包含的路径不会单独出现在命令里
+        :return: 没能删除的路径(命令无法执行或执行失败时)，由调用者逐个删除
+        """
+        targets = {self.confine(p): p for p in paths}
+
+        def ancestors(target):
+            return [target[:i] for i in range(1, len(target)) if target[i] == '/']
+
+        # 命令行长度有限，分成多条命令执行
+        commands = [[]]
+        length = 0
+        for target in targets:
+            if any(a in targets for a in ancestors(target)):
+                continue
+            if length + len(target) > self.commandLength and len(commands[-1]) > 0:
+                commands.append([])
+                length = 0
+            commands[-1].append(target)
+            length += len(target) + 3
+
+        for i, command in enumerate(commands):
+            try:
+                status, output = self.sftp.exec_command('rm -rf -- ' + ' '.join(shlex.quote(t) for t in command))
+                error = None if status == 0 else f'退出码{status}: {output.strip()}'
+            except paramiko.SSHException as e:
+                error = repr(e)
+            if error is not None:
+                print(f'无法在服务器上执行删除命令，改为逐个删除: {error}')
+                failed = set(t for c in commands[i:] for t in c)
+                return [p for t, p in targets.items() if t in failed or any(a in failed for a in ancestors(t))]
+        return []
+
     def uploadObject(self, remote_path, local_path, base_dir, length, file_hash):
-        self.sftp.upload_file(local_path, remote_path, False)
+        # 上传交给通道池里的多个通道同时进行
+        self.addUploadTask({
+            "local": local_path,
+            "remote": remote_path
+        }, length, remote_path)
         self.modified = True
 
+    def uploadWorker(self, task):
+        return self.pool.run(lambda channel: self.sftp.put_file(channel, task["local"], task["remote"]))
+
+    def startParallelUploadWork(self, threads: int = 16, batches=None, baseDir=None):
+        # 线程数不超过通道数，多出来的线程只会等待空闲通道
+        super(SFTP, self).startParallelUploadWork(min(threads, self.connections), batches, baseDir)
+
     def makeDirectory(self, path):
         self.sftp.create_directory(path)
         self.modified = True
 
     def cleanup(self):
-        if self.modified:
+        self.pool.close()
+
+        # 有文件上传失败时不能更新缓存，否则下次上传时会认为这些文件已经存在
+        if len(self.uploadFailures) > 0:
+            print('有文件上传失败，跳过更新缓存')
+        elif self.modified:
             print('正在更新缓存...')
-            cache = dir_hash(self.rootDir)
             # 虽然可以直接修改，但是删除重传就完事了
             try:
                 self.sftp.delete_file(self.cacheFileName)
@@ -177,7 +364,8 @@ class SFTP(AbstractServiceProvider):
                 pass
             buf = BufferedRandom(io.BytesIO())
             # buf.write(yaml.safe_dump(cache, sort_keys=False, canonical=True).encode('utf-8'))
-            cacheContent = json.dumps(cache, ensure_ascii=False)
+            cacheContent = self.uploadTool.snapshot.document
+            buf.write(cacheContent.encode('utf-8'))
             buf.seek(0)
             self.sftp.upload_file(buf, self.cacheFileName, True)
             print(f'缓存已更新 {self.cacheFileName}')
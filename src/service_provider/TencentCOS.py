@@ -1,12 +1,15 @@
-import json
+import hashlib
 import re
+import time
 import yaml
-import os.path
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
 from io import BytesIO
-from typing import Optional, List
+from threading import BoundedSemaphore
+from typing import Optional
 from qcloud_cos import CosS3Client, CosConfig, CosServiceError
-from src.utilities.dir_hash import dir_hash
 from src.utilities.file import File
+from src.utilities.key_structure import keys_to_structure
 from src.service_provider.ParallelUploadServiceProvider import ParallelUploadServiceProvider
 
 # 修复 Python 3.10 的不兼容性
@@ -44,41 +47,36 @@ class TencentCOS(ParallelUploadServiceProvider):
         self.cacheFileName = config['cache_file']
         self.headerRules = config['header_rules'] if 'header_rules' in config else []
         self.allow_empty_directory = config.get('allow_empty_directory', False)
+        self.partSize = config.get('part_size', 8 * 1024 * 1024)  # 分片大小，超过这个大小的文件使用分片上传
+        self.partThreads = config.get('part_threads', 4)  # 单个文件同时上传的分片数
+        # 所有线程共享的连接数限制，单文件上传和分片上传都要先获取，避免总并发数超过上传线程数
+        self.connectionSlots = BoundedSemaphore(uploadTool.config.get('upload_threads', 16))
+        self.fragments = {}  # 可以续传的分片上传：key -> UploadId
 
     def initialize(self, rootDir: File):
         self.rootDir = rootDir
 
     def fetchDirectory(self):
-        entries: List[str] = []
+        entries = []
         marker = ''
 
         while True:
             response = self.client.list_objects(Bucket=self.bucket, MaxKeys=1000, Prefix=self.prefix, Marker=marker)
             if 'Contents' in response:
-                entries += [e["Key"] for e in response['Contents']]
+                for e in response['Contents']:
+                    path = e['Key'][len(self.prefix):]  # 在路径计算前移除 prefix
+                    info = None if path.endswith('/') else {
+                        'length': int(e['Size']),
+                        'hash': '',
+                        'etag': e['ETag'].strip('"')
+                    }
+                    entries.append((path, info))
             if response['IsTruncated'] == 'false':
                 break
             marker = response['NextMarker']
 
-        # 将路径计算过程移至本地，减少网络请求开销（尽管这个算法并不讨巧但是比网络请求快多了）
-        structure = []
-        for entry in entries:
-            isdir = entry.endswith('/')
-            path = entry[len(self.prefix):]  # 在路径计算前移除 prefix
-            path = path.rstrip('/') if isdir else path
-            basename = os.path.basename(path)
-            dirname = os.path.dirname(path)
-            cursor = structure
-            if dirname is not '':
-                for dirLevel in dirname.split('/'):
-                    if len(list(filter(lambda x: x['name'] == dirLevel, cursor))) == 0:
-                        cursor.append({'name': dirLevel, 'children': []})
-                    cursor = next(filter(lambda x: x['name'] == dirLevel, cursor))['children']
-            if isdir:
-                cursor.append({'name': basename, 'children': []})
-            else:
-                cursor.append({'name': basename, 'length': 0, 'hash': ''})
-        return structure
+        # 将路径计算过程移至本地，减少网络请求开销
+        return keys_to_structure(entries)
 
     def fetchAll(self):
         if self.exists(self.cacheFileName):
@@ -86,15 +84,40 @@ class TencentCOS(ParallelUploadServiceProvider):
             print('缓存已找到 ' + self.cacheFileName)
             return self.cache
 
+        # 没有缓存时使用列出的大小和ETag对比文件，对比结束后需要重新生成缓存
+        self.modified = True
         return self.fetchDirectory()
 
     def fetchFragments(self):
-        result = []
-        fragments = self.client.list_multipart_uploads(Bucket=self.bucket)
-        if 'Upload' in fragments:
-            for f in fragments['Upload']:
-                result += [f['Key']]
-        return result
+        uploads = {}  # key -> [(开始时间, UploadId)]，同一个文件可能有多次未完成的分片上传
+        maxAge = self.uploadTool.config.get('fragment_max_age', 72) * 3600
+        keyMarker = ''
+        uploadIdMarker = ''
+
+        while True:
+            fragments = self.client.list_multipart_uploads(
+                Bucket=self.bucket, Prefix=self.prefix, KeyMarker=keyMarker, UploadIdMarker=uploadIdMarker)
+            for f in fragments.get('Upload', []):
+                initiated = datetime.fromisoformat(f['Initiated'].replace('Z', '+00:00')).timestamp()
+                if time.time() - initiated > maxAge:
+                    # 过期的碎片不再续传，直接清理掉，避免一直占用存储空间
+                    print('清理过期的文件碎片: ' + f['Key'])
+                    self.client.abort_multipart_upload(Bucket=self.bucket, Key=f['Key'], UploadId=f['UploadId'])
+                else:
+                    uploads.setdefault(f['Key'], []).append((initiated, f['UploadId']))
+            if fragments['IsTruncated'] == 'false':
+                break
+            keyMarker = fragments['NextKeyMarker']
+            uploadIdMarker = fragments['NextUploadIdMarker']
+
+        for key, candidates in uploads.items():
+            # 续传最新的一次，其余的不会再用到，清理掉
+            candidates.sort()
+            for initiated, uploadId in candidates[:-1]:
+                print('清理重复的文件碎片: ' + key)
+                self.client.abort_multipart_upload(Bucket=self.bucket, Key=key, UploadId=uploadId)
+            self.fragments[key] = candidates[-1][1]
+        return list(uploads.keys())
 
     def deleteObjects(self, paths):
         for i in range(0, len(paths), 999):
@@ -116,19 +139,74 @@ class TencentCOS(ParallelUploadServiceProvider):
             print(headers)
 
         # 仅仅将上传添加到队列，等到下一步（CleanUp）再使用多线程上传
-        self.uploadInboundQueue.put({
+        self.addUploadTask({
             "key": self.prefix + path,
             "local": localPath,
-            "headers": headers
-        })
+            "length": length,
+            "headers": {'x-cos-meta-hash': hash, **headers}
+        }, length, path)
         self.modified = True
 
     def uploadWorker(self, task):
-        result = self.uploadClient.upload_file(
-            Bucket=self.bucket, Key=task["key"], LocalFilePath=task["local"],
-            EnableMD5=True, Metadata=task["headers"])
+        # 文件大小和校验在对比时已经计算过了，这里不再读取文件计算MD5
+        if task["length"] < self.partSize:
+            with self.connectionSlots, open(task["local"], 'rb') as f:
+                return self.uploadClient.put_object(Bucket=self.bucket, Key=task["key"], Body=f, Metadata=task["headers"])
+        return self.multipartUpload(task)
+
+    def multipartUpload(self, task):
+        """分片上传，分片由partThreads个线程同时上传，每个分片都要占用一个连接数
+
+        如果这个文件有未完成的分片上传(文件碎片)，会校验已经上传的分片，只上传缺失或者不一致的分片
+        """
+        # COS最多支持10000个分片
+        length = task["length"]
+        partSize = max(self.partSize, -(-length // 10000))
+        partCount = -(-length // partSize)
+
+        uploadId = self.fragments.get(task["key"])
+        uploaded = self.listParts(task["key"], uploadId) if uploadId is not None else {}
+        if uploadId is None:
+            uploadId = self.uploadClient.create_multipart_upload(
+                Bucket=self.bucket, Key=task["key"], Metadata=task["headers"])['UploadId']
+            # 上传失败时保留分片，重试或者下次运行时可以续传
+            self.fragments[task["key"]] = uploadId
+
+        def uploadPart(number):
+            with self.connectionSlots:
+                with open(task["local"], 'rb') as f:
+                    f.seek((number - 1) * partSize)
+                    data = f.read(partSize)
+                part = uploaded.get(number)
+                if part is not None and part['Size'] == len(data) and part['ETag'] == hashlib.md5(data).hexdigest():
+                    return {'PartNumber': number, 'ETag': part['ETag']}
+                response = self.uploadClient.upload_part(
+                    Bucket=self.bucket, Key=task["key"], Body=data, PartNumber=number, UploadId=uploadId)
+            return {'PartNumber': number, 'ETag': response['ETag']}
+
+        with ThreadPoolExecutor(self.partThreads) as pool:
+            parts = list(pool.map(uploadPart, range(1, partCount + 1)))
+        result = self.uploadClient.complete_multipart_upload(
+            Bucket=self.bucket, Key=task["key"], UploadId=uploadId, MultipartUpload={'Part': parts})
+        self.fragments.pop(task["key"], None)
         return result
 
+    def listParts(self, key, uploadId):
+        """列出分片上传中已经上传的分片：分片编号 -> {'Size': 大小, 'ETag': MD5}"""
+        parts = {}
+        marker = 0
+        while True:
+            response = self.uploadClient.list_parts(
+                Bucket=self.bucket, Key=key, UploadId=uploadId, PartNumberMarker=marker)
+            for p in response.get('Part', []):
+                parts[int(p['PartNumber'])] = {'Size': int(p['Size']), 'ETag': p['ETag'].strip('"').lower()}
+            if response['IsTruncated'] == 'false':
+                break
+            marker = response['NextPartNumberMarker']
+        if len(parts) > 0:
+            print(f'\n续传文件碎片 {key}: 已上传{len(parts)}个分片')
+        return parts
+
     def downloadObject(self, path):
         buf = BytesIO()
         response = self.client.get_object(Bucket=self.bucket, Key=self.prefix + path)
@@ -154,16 +232,20 @@ class TencentCOS(ParallelUploadServiceProvider):
             raise e
 
     def cleanup(self):
+        # 有文件上传失败时不能更新缓存，否则下次上传时会认为这些文件已经存在
+        if len(self.uploadFailures) > 0:
+            print('有文件上传失败，跳过更新缓存')
+            return
+
         # 实际上传文件之后，需要更新缓存文件
         if self.modified:
             print('正在更新缓存...')
-            cache = dir_hash(self.rootDir)
 
             if self.exists(self.cacheFileName):
                 self.deleteObjects([self.cacheFileName])
 
             # cacheContent = yaml.safe_dump(cache, sort_keys=False, canonical=True).encode('utf-8')
-            cacheContent = json.dumps(cache, ensure_ascii=False)
+            cacheContent = self.uploadTool.snapshot.document
             self.client.put_object(Bucket=self.bucket, Key=self.prefix + self.cacheFileName, Body=cacheContent)
 
             print('缓存已更新 ' + self.cacheFileName)
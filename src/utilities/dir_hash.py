@@ -1,19 +1,170 @@
+import sys
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+
 from src.utilities.file import File
+from src.utilities.hash_algorithms import hashAlgorithms
+from src.utilities.hash_index import HashIndex
+from src.utilities.tree_walker import scan_tree
+
+smallFileSize = 64 * 1024  # 小于这个大小的文件算作小文件
+smallFileBatch = 256  # 每次交给进程池的小文件数量
+processPoolThreshold = 4096  # 小文件数量超过这个值时才使用进程池，避免进程启动开销得不偿失
+windowsMaxProcesses = 61  # Windows上ProcessPoolExecutor最多支持的进程数，超过时会抛出ValueError
+
+
+def dir_hash(dir: File, index: HashIndex = None, workers: int = 1, algorithm: str = 'sha1'):
+    """计算目录结构
+    :param index: 本地校验索引
+    :param workers: 并行计算校验的线程/进程数，为1时在当前线程中计算
+    :param algorithm: 校验算法，见hashAlgorithms
+    """
+    return nodes_hash(scan_tree(dir.path), index, workers, algorithm)
+
+
+def nodes_hash(nodes: list, index: HashIndex = None, workers: int = 1, algorithm: str = 'sha1'):
+    """根据scan_tree的扫描结果计算目录结构"""
+    return nodes_hashes(nodes, index, workers, [algorithm])[algorithm]
+
 
+def nodes_hashes(nodes: list, index: HashIndex = None, workers: int = 1, algorithms: list = ('sha1',)):
+    """根据scan_tree的扫描结果同时计算多种校验算法的目录结构，每个文件最多只读取一次
+    :return: 校验算法 -> 目录结构
+    """
+    pending = []
+    structures = nodes_structure(nodes, pending, algorithms)
+    fill_hashes(pending, index, workers)
+    return structures
 
-def dir_hash(dir: File):
-    structure = []
-    for f in dir:
+
+def nodes_structure(nodes: list, pending: list, algorithms: list = ('sha1',)):
+    """生成每种校验算法的目录结构，文件的校验先留空，并将({校验算法: 结构条目}, 文件)添加到pending中等待计算
+    :return: 校验算法 -> 目录结构
+    """
+    structures = {algorithm: [] for algorithm in algorithms}
+    for f in nodes:
         if f.isFile:
-            structure.append({
-                'name': f.name,
-                'length': f.length,
-                'hash': f.sha1,
-                'modified': f.modifiedTime
-            })
-        if f.isDirectory:
-            structure.append({
-                'name': f.name,
-                'children': dir_hash(f)
-            })
-    return structure
+            entries = {}
+            for algorithm in algorithms:
+                entries[algorithm] = {
+                    'name': f.name,
+                    'length': f.length,
+                    'hash': None,
+                    'modified': f.modified,
+                    'modified_ns': f.mtimeNs
+                }
+                structures[algorithm].append(entries[algorithm])
+            pending.append((entries, f))
+        else:
+            children = nodes_structure(f.children, pending, algorithms)
+            for algorithm in algorithms:
+                structures[algorithm].append({
+                    'name': f.name,
+                    'children': children[algorithm]
+                })
+    return structures
+
+
+def lookup_hashes(entries: dict, f, index: HashIndex = None):
+    """从校验索引中查找各校验算法的校验并填写到结构条目里
+    :return: 索引中没有、需要读取文件计算的校验算法
+    """
+    missing = []
+    for algorithm, entry in entries.items():
+        hash = index.lookup(f, algorithm) if index is not None else None
+        if hash is None:
+            missing.append(algorithm)
+        else:
+            entry['hash'] = hash
+    return missing
+
+
+def store_hashes(entries: dict, f, algorithms: list, hashes: list, index: HashIndex = None):
+    """将新计算的校验填写到结构条目里并记录到校验索引"""
+    for algorithm, hash in zip(algorithms, hashes):
+        entries[algorithm]['hash'] = hash
+        if index is not None:
+            index.store(f, algorithm, hash)
+
+
+def fill_hashes(pending: list, index: HashIndex = None, workers: int = 1):
+    """计算pending中所有文件的校验，并填写到对应的结构条目里，同一个文件的多种校验在一次读取中计算"""
+    missing = []
+    for entries, f in pending:
+        algorithms = lookup_hashes(entries, f, index)
+        if len(algorithms) > 0:
+            missing.append((entries, f, algorithms))
+
+    if workers <= 1:
+        results = [(m, m[1].digests(m[2])) for m in missing]
+    else:
+        small = [m for m in missing if m[1].length < smallFileSize]
+        if len(small) >= processPoolThreshold:
+            large = [m for m in missing if m[1].length >= smallFileSize]
+        else:
+            small, large = [], missing
+        batches = [small[i:i + smallFileBatch] for i in range(0, len(small), smallFileBatch)]
+
+        # 大文件交给线程池(hashlib计算时会释放GIL)，大量小文件分批交给进程池
+        processes = ProcessPoolExecutor(processCount(workers)) if len(batches) > 0 else None
+        try:
+            batchFutures = [processes.submit(digest_batch, [(m[1].path, m[2]) for m in batch]) for batch in batches]
+            with ThreadPoolExecutor(workers) as threads:
+                results = list(zip(large, threads.map(lambda m: m[1].digests(m[2]), large)))
+            for batch, future in zip(batches, batchFutures):
+                results += zip(batch, future.result())
+        finally:
+            if processes is not None:
+                processes.shutdown()
+
+    for (entries, f, algorithms), hashes in results:
+        store_hashes(entries, f, algorithms, hashes, index)
+
+
+def processCount(workers: int):
+    """进程池的进程数，hash_workers为auto时在逻辑核心很多的Windows电脑上可能超过上限"""
+    if sys.platform == 'win32':
+        return min(workers, windowsMaxProcesses)
+    return workers
+
+
+def digest_batch(files: list):
+    """在子进程中计算一批小文件的校验
+    :param files: [(文件路径, [校验算法])]
+    """
+    return [File(path).checksums([hashAlgorithms[a]() for a in algorithms]) for path, algorithms in files]
+
+
+def stream_hashes(pending: list, index: HashIndex = None, workers: int = 1):
+    """与fill_hashes相同，但是按pending的顺序边计算边产出({校验算法: 结构条目}, 文件)，产出时条目的校验已经填好
+
+    所有文件都交给线程池计算(不使用进程池)，结果按顺序取出，前面的文件算好就可以先交给调用者；
+    同时最多只有2*workers个文件在计算或等待取出，调用者处理得慢时不会提前读完所有文件
+    """
+    workers = max(workers, 1)
+    window = deque()
+    items = iter(pending)
+    with ThreadPoolExecutor(workers) as threads:
+        def submit():
+            # 索引中已有的文件不需要计算，直接排在队列里
+            for entries, f in items:
+                algorithms = lookup_hashes(entries, f, index)
+                future = threads.submit(f.digests, algorithms) if len(algorithms) > 0 else None
+                window.append((entries, f, algorithms, future))
+                if future is not None:
+                    return
+
+        try:
+            for _ in range(workers * 2):
+                submit()
+            while len(window) > 0:
+                entries, f, algorithms, future = window.popleft()
+                if future is not None:
+                    store_hashes(entries, f, algorithms, future.result(), index)
+                    submit()
+                yield entries, f
+        finally:
+            # 调用者提前结束时不再计算剩下的文件
+            for entries, f, algorithms, future in window:
+                if future is not None:
+                    future.cancel()
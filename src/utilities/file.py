@@ -7,6 +7,9 @@ import pathlib
 
 # 1.1 2021年2月7日18:58:49
 class File:
+    hashBlockSize = 1024 * 1024  # 计算校验时每次读取的字节数
+    hashBufferThreshold = 16 * 1024 * 1024  # 超过这个大小的文件使用复用的缓冲区读取(readinto)
+
     def __init__(self, filePath):
         if not isinstance(filePath, str):
             raise TypeError(f"the file path must be a string, not '{filePath}' ({type(filePath)})")
@@ -191,10 +194,34 @@ class File:
         if self.isDirectory:
             raise IsADirectoryError(f"'{self.path}' was not a file")
 
-        with open(self.path, 'rb') as f:
-            sha1obj = hashlib.sha1()
-            sha1obj.update(f.read())
-            return sha1obj.hexdigest()
+        return self.checksum(hashlib.sha1())
+
+    def checksum(self, hashobj):
+        """分块计算文件的校验，内存占用不随文件大小增长
+        :param hashobj: hashlib的hash对象
+        """
+        return self.checksums([hashobj])[0]
+
+    def checksums(self, hashobjs: list):
+        """只读取一次文件，同时计算多种校验
+        :param hashobjs: hashlib的hash对象列表
+        :return: 与hashobjs顺序相同的校验列表
+        """
+        with open(self.path, 'rb', buffering=0) as f:
+            if os.fstat(f.fileno()).st_size <= File.hashBufferThreshold:
+                for block in iter(lambda: f.read(File.hashBlockSize), b''):
+                    for hashobj in hashobjs:
+                        hashobj.update(block)
+            else:
+                buffer = bytearray(File.hashBlockSize)
+                view = memoryview(buffer)
+                while True:
+                    read = f.readinto(buffer)
+                    if not read:
+                        break
+                    for hashobj in hashobjs:
+                        hashobj.update(view[:read])
+        return [hashobj.hexdigest() for hashobj in hashobjs]
 
     @property
     def hash(self):
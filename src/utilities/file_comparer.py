@@ -1,12 +1,17 @@
+from src.utilities.dir_hash import dir_hash
 from src.utilities.file import File
 
 
 class SimpleFileObject:
-    def __init__(self, name: str, length: int = None, hash: str = None, children: list = None):
+    __slots__ = ('name', 'length', 'hash', 'etag', 'children', '__index')
+
+    def __init__(self, name: str, length: int = None, hash: str = None, children: list = None, etag: str = None):
         self.name = name
         self.length = length
         self.hash = hash
+        self.etag = etag  # 对象存储列出的ETag，只有在没有缓存时才会有
         self.children = children
+        self.__index = None  # 文件名 -> 子文件，首次按名字查找时建立
 
         isFile = self.isFile
         isDir = self.isDirectory
@@ -28,7 +33,7 @@ class SimpleFileObject:
             children = [SimpleFileObject.FromDict(f) for f in obj['children']]
             return SimpleFileObject(obj['name'], children=children)
         else:
-            return SimpleFileObject(obj['name'], length=obj['length'], hash=obj['hash'])
+            return SimpleFileObject(obj['name'], length=obj['length'], hash=obj['hash'], etag=obj.get('etag'))
 
     @staticmethod
     def FromFile(file: File):
@@ -57,33 +62,26 @@ class SimpleFileObject:
         return self.hash
 
     def getByName(self, name):
-        for child in self.children:
-            if child.name == name:
-                return child
-        return None
-
-    class Iter:
-        def __init__(self, obj):
-            self.files = obj.files
-            self.index = 0
-            self.end = len(self.files)
-
-        def __next__(self):
-            if self.index < self.end:
-                ret = self.files[self.index]
-                self.index += 1
-                return ret
-            else:
-                raise StopIteration
+        return self.index.get(name)
+
+    @property
+    def index(self):
+        """按名字索引的子文件，children在建立索引后不应再修改"""
+        if self.__index is None:
+            self.__index = {}
+            for child in self.children:
+                self.__index.setdefault(child.name, child)
+        return self.__index
 
     def __getitem__(self, name: str):
         if not isinstance(name, str):
             raise TypeError(f"The file must be a string, not '{name}' ({type(name)})")
 
-        if not self.__contains__(name):
+        child = self.getByName(name)
+        if child is None:
             raise FileNotFoundError(f"'{name}' is not found")
 
-        return self.getByName(name)
+        return child
 
     def __call__(self, relPath):
         return self.__getitem__(relPath)
@@ -92,17 +90,24 @@ class SimpleFileObject:
         if not isinstance(file, str):
             raise TypeError(f"The key must be a string, not '{file}' ({type(file)})")
 
-        for subFile in self.children:
-            if subFile.name == file:
-                return True
-
-        return False
+        return file in self.index
 
     def __len__(self):
         return len(self.children)
 
     def __iter__(self):
-        return self.Iter(self)
+        return iter(self.files)
+
+
+def compareByHash(remote: SimpleFileObject, local: SimpleFileObject, path: str):
+    """只比较校验"""
+    return remote.sha1 == local.sha1
+
+
+# 文件对比策略，对比时都是比较校验(compareByHash)，区别只在于本地校验的来源：
+# metadata的本地校验在大小和修改时间与远程缓存相同时直接取自缓存(见LocalSnapshot.trustRemote)，
+# strict使用本地校验索引跳过没有变化的文件，paranoid不使用校验索引，总是重新读取文件内容计算校验
+compareStrategies = ('metadata', 'strict', 'paranoid')
 
 
 class FileComparer2:
@@ -110,51 +115,58 @@ class FileComparer2:
         super().__init__()
         self.basePath = basePath
 
-        def defaultCompareFunc(remoteFile: SimpleFileObject, localRelPath: str, localAbsPath: str):
-            return remoteFile.sha1 == File(localAbsPath).sha1
-
-        self.compareFunc = compareFunc if compareFunc is not None else defaultCompareFunc
+        self.compareFunc = compareFunc if compareFunc is not None else compareByHash
 
         self.oldFiles = []
         self.oldFolders = []
         self.newFiles = {}
         self.newFolders = []
+        self.remote = None  # 流水线模式下的远程文件结构
 
-    def findNewFiles(self, current: SimpleFileObject, template: File):
+        # 对比过程中先用dict收集(去重并保持顺序)，对比结束后再转换成上面的列表
+        self.__oldFiles = {}
+        self.__oldFolders = {}
+        self.__newFolders = {}
+
+    def findNewFiles(self, current: SimpleFileObject, template: SimpleFileObject, dir: str = ''):
         """只扫描新增的文件(不包括被删除的)
         :param current: 远程文件结构(目录)
         :param template: 本地文件结构(目录)
+        :param dir: template的相对路径
         """
 
         for t in template:
+            path = self.joinPath(dir, t.name)
+
             if t.name not in current:  # 文件不存在
-                self.addNewFile(SimpleFileObject.FromFile(t), t)
+                self.addNewFile(t, path)
             else:  # 文件存在的话要进行进一步判断
                 corresponding = current(t.name)
 
                 if t.isDirectory:
                     if corresponding.isFile:
                         # 先删除旧的再获取新的
-                        self.addOldFile(corresponding, template.relPath(self.basePath))
-                        self.addNewFile(corresponding, t)
+                        self.addOldFile(corresponding, dir)
+                        self.addNewFile(t, path)
                     else:
-                        self.findNewFiles(corresponding, t)
+                        self.findNewFiles(corresponding, t, path)
                 else:
                     if corresponding.isFile:
                         # if corresponding.sha1 != t.sha1:  # 校验hash
-                        if not self.compareFunc(corresponding, t.path, t.relPath(self.basePath)):
+                        if not self.compareFunc(corresponding, t, path):
                             # 先删除旧的再获取新的
-                            self.addOldFile(corresponding, template.relPath(self.basePath))
-                            self.addNewFile(corresponding, t)
+                            self.addOldFile(corresponding, dir)
+                            self.addNewFile(t, path)
                     else:
                         # 先删除旧的再获取新的
-                        self.addOldFile(corresponding, template.relPath(self.basePath))
-                        self.addNewFile(corresponding, t)
+                        self.addOldFile(corresponding, dir)
+                        self.addNewFile(t, path)
 
-    def findOldFiles(self, current: SimpleFileObject, template: File):
+    def findOldFiles(self, current: SimpleFileObject, template: SimpleFileObject, dir: str = ''):
         """只扫描需要删除的文件
         :param current: 远程文件结构(目录)
         :param template: 本地文件结构(目录)
+        :param dir: template的相对路径
         """
 
         for c in current:
@@ -162,59 +174,139 @@ class FileComparer2:
                 corresponding = template(c.name)
                 # 如果两边都是目录，递归并进一步判断
                 if c.isDirectory and corresponding.isDirectory:
-                    self.findOldFiles(c, corresponding)
+                    self.findOldFiles(c, corresponding, self.joinPath(dir, c.name))
                 # 其它情况均由findMissingFiles进行处理了，这里不需要重复计算
             else:  # 如果远程端没有有这个文件，就直接删掉好了
-                self.addOldFile(c, template.relPath(self.basePath))
+                self.addOldFile(c, dir)
 
     def addOldFile(self, file: SimpleFileObject, dir: str):
         """添加需要删除的文件/目录
         :param file: 删除的文件(文件/目录)
         :param dir: file所在的目录(文件/目录)
         """
-        path = dir + '/' + file.name
-        pathWithoutDotSlash = path[2:] if path.startswith('./') else path
+        path = self.joinPath(dir, file.name)
 
         if file.isDirectory:
             for u in file:
                 if u.isDirectory:
                     self.addOldFile(u, path)
                 else:
-                    newPath = path + '/' + u.name
-                    self.oldFiles += [newPath[2:] if newPath.startswith('./') else newPath]
+                    self.__oldFiles[self.joinPath(path, u.name)] = None
 
-            self.oldFolders += [pathWithoutDotSlash]
+            self.__oldFolders[path] = None
         else:
-            self.oldFiles += [pathWithoutDotSlash]
+            self.__oldFiles[path] = None
 
-    def addNewFile(self, missing: SimpleFileObject, template: File):
+    def addNewFile(self, missing: SimpleFileObject, path: str):
         """添加需要传输的文件
-        :param missing: 缺失的文件对象(文件/目录)
-        :param template: 对照模板(文件/目录)
-        :return:
+        :param missing: 缺失的本地文件对象(文件/目录)
+        :param path: missing的相对路径
         """
 
-        if missing.isDirectory != template.isDirectory:
-            assert False, 'the types did not equal'
-
         if missing.isDirectory:
-            folder = template.relPath(self.basePath)
-            if folder not in self.newFolders and folder != '.':
-                self.newFolders += [folder]
+            if path != '':
+                self.__newFolders[path] = None
             for m in missing:
-                mCorresponding = template(m.name)
-                if m.isDirectory:
-                    self.addNewFile(m, mCorresponding)
-                else:
-                    self.newFiles[mCorresponding.relPath(self.basePath)] = [m.length, m.hash]
+                self.addNewFile(m, self.joinPath(path, m.name))
         else:
-            self.newFiles[template.relPath(self.basePath)] = [template.length, template.sha1]
+            self.newFiles[path] = [missing.length, missing.hash]
+
+    def findNewFolders(self, current: SimpleFileObject, template: SimpleFileObject, dir: str = ''):
+        """只扫描新增的目录，以及类型与本地不同、需要先删除的远程文件/目录(流水线模式，不对比文件内容)
+        :param current: 远程文件结构(目录)
+        :param template: 本地文件结构(目录)
+        :param dir: template的相对路径
+        """
+
+        for t in template:
+            path = self.joinPath(dir, t.name)
 
-    def compareWithSimpleFileObject(self, current: File, template: SimpleFileObject):
-        self.findNewFiles(template, current)
-        self.findOldFiles(template, current)
+            if t.name not in current:
+                if t.isDirectory:
+                    self.addNewFolder(t, path)
+            else:
+                corresponding = current(t.name)
 
-    def compareWithList(self, current: File, template: list):
-        template2 = {'name': '', 'children': template}
-        self.findNewFiles(SimpleFileObject.FromDict(template2), current)
-        self.findOldFiles(SimpleFileObject.FromDict(template2), current)
+                if t.isDirectory != corresponding.isDirectory:
+                    # 先删除旧的再创建新的
+                    self.addOldFile(corresponding, dir)
+                    if t.isDirectory:
+                        self.addNewFolder(t, path)
+                elif t.isDirectory:
+                    self.findNewFolders(corresponding, t, path)
+
+    def addNewFolder(self, missing: SimpleFileObject, path: str):
+        """添加需要创建的目录(包括所有子目录)"""
+        self.__newFolders[path] = None
+        for m in missing:
+            if m.isDirectory:
+                self.addNewFolder(m, self.joinPath(path, m.name))
+
+    def findRemote(self, path: str):
+        """在远程文件结构中查找相对路径对应的文件/目录，找不到时返回None"""
+        node = self.remote
+        for name in path.split('/'):
+            if not node.isDirectory or name not in node:
+                return None
+            node = node(name)
+        return node
+
+    @staticmethod
+    def joinPath(dir: str, name: str):
+        return dir + '/' + name if dir != '' else name
+
+    @staticmethod
+    def loadLocal(current):
+        """加载本地文件结构
+        :param current: 本地目录(File)，或者dir_hash格式的结构列表(比如LocalSnapshot.structure)
+        """
+        if isinstance(current, File):
+            current = dir_hash(current)
+        return SimpleFileObject.FromDict({'name': '', 'children': current})
+
+    def collectResults(self):
+        """将对比结果转换成列表"""
+        self.oldFiles = list(self.__oldFiles)
+        self.oldFolders = list(self.__oldFolders)
+        self.newFolders = list(self.__newFolders)
+
+    def compareWithSimpleFileObject(self, current, template: SimpleFileObject):
+        local = self.loadLocal(current)
+        self.findNewFiles(template, local)
+        self.findOldFiles(template, local)
+        self.collectResults()
+
+    def prepareStreaming(self, current, template: list, keep=()):
+        """流水线模式的第一步：只根据文件名和类型计算需要删除的文件/目录和需要创建的目录，
+        文件内容交给iterNewFiles()边计算校验边对比
+        :param current: 本地文件结构(校验可以留空)
+        :param template: 远程文件结构
+        :param keep: 本地暂时还没有、但不能删除的顶层文件名(之后才生成的结构文件)
+        """
+        self.remote = SimpleFileObject.FromDict({'name': '', 'children': template})
+        local = self.loadLocal(current)
+        self.findNewFolders(self.remote, local)
+        self.findOldFiles(self.remote, local)
+        self.collectResults()
+        self.oldFiles = [f for f in self.oldFiles if f not in keep]
+
+    def iterNewFiles(self, files):
+        """流水线模式：逐个对比本地文件，产出需要上传的文件，需要先调用prepareStreaming()
+
+        内容有变化的文件直接覆盖，不会像compareWithList()那样先加入oldFiles删除
+        :param files: 可迭代的(相对路径, 结构条目)，条目的校验已经计算好
+        :return: 生成器，产出(相对路径, 文件大小, 文件校验)，同时记录到newFiles里
+        """
+        for path, entry in files:
+            local = SimpleFileObject.FromDict(entry)
+            remote = self.findRemote(path)
+            if remote is None or not remote.isFile or not self.compareFunc(remote, local, path):
+                self.newFiles[path] = [local.length, local.hash]
+                yield path, local.length, local.hash
+
+    def compareWithList(self, current, template: list):
+        template2 = SimpleFileObject.FromDict({'name': '', 'children': template})
+        local = self.loadLocal(current)
+        self.findNewFiles(template2, local)
+        self.findOldFiles(template2, local)
+        self.collectResults()
@@ -0,0 +1,55 @@
+import hashlib
+import json
+
+# 可用的校验算法，更新客户端只认识sha1；md5用于没有缓存时和对象存储列出的ETag对比
+hashAlgorithms = {
+    'sha1': hashlib.sha1,
+    'blake2b': hashlib.blake2b,
+    'blake2s': hashlib.blake2s,
+    'md5': hashlib.md5,
+}
+
+
+cacheOnlyFields = ('modified_ns',)  # 只有远程缓存需要的字段，不写入结构文件
+
+
+def strip_structure(structure: list):
+    """去掉只有远程缓存需要的字段，用于生成结构文件"""
+    result = []
+    for f in structure:
+        if 'children' in f:
+            result.append({'name': f['name'], 'children': strip_structure(f['children'])})
+        else:
+            result.append({k: v for k, v in f.items() if k not in cacheOnlyFields})
+    return result
+
+
+def dump_structure(structure: list, algorithm: str):
+    """将目录结构序列化为结构文件/缓存文件的内容
+
+    sha1使用旧的列表格式以兼容更新客户端和旧版本的缓存，其它算法会在文档中记录算法名
+    """
+    if algorithm == 'sha1':
+        return json.dumps(structure, ensure_ascii=False)
+    return json.dumps({'version': 2, 'algorithm': algorithm, 'structure': structure}, ensure_ascii=False)
+
+
+def load_structure(document):
+    """解析结构文件/缓存文件的内容
+    :return: (目录结构, 校验算法)，没有缓存、只有目录列表(不含校验)时校验算法为None
+    """
+    if isinstance(document, list):
+        file = first_file(document)
+        return document, 'sha1' if file is not None and file['hash'] else None
+    return document['structure'], document['algorithm']
+
+
+def first_file(structure: list):
+    """找到目录结构中的第一个文件，没有文件时返回None"""
+    for f in structure:
+        if 'children' not in f:
+            return f
+        found = first_file(f['children'])
+        if found is not None:
+            return found
+    return None
@@ -0,0 +1,100 @@
+import sqlite3
+
+from src.utilities.file import File
+from src.utilities.tree_walker import FileNode
+
+
+class HashIndex:
+    """本地校验索引
+
+    以(路径, 大小, 修改时间, inode)为键记录文件的校验，文件没有变化时直接复用上次的结果，
+    只有stat信息发生变化的文件才会重新计算
+    """
+    schemaVersion = 2
+
+    def __init__(self, indexFile: File):
+        self.indexFile = indexFile
+        self.entries = {}  # (路径, 算法) -> (大小, 修改时间(纳秒), inode, 校验)
+        self.updated = {}  # 本次运行中新计算的条目
+        self.visited = set()  # 本次运行中访问过的路径
+
+        self.connection = sqlite3.connect(indexFile.path)
+
+        # 索引只是缓存，格式不兼容时直接重建
+        if self.connection.execute('PRAGMA user_version').fetchone()[0] != HashIndex.schemaVersion:
+            self.connection.execute('DROP TABLE IF EXISTS hashes')
+            self.connection.execute(f'PRAGMA user_version = {HashIndex.schemaVersion}')
+        self.connection.execute('CREATE TABLE IF NOT EXISTS hashes (path TEXT, algorithm TEXT, length INTEGER, '
+                                'modified INTEGER, inode INTEGER, hash TEXT, PRIMARY KEY (path, algorithm))')
+
+        for path, algorithm, length, modified, inode, hash in self.connection.execute('SELECT * FROM hashes'):
+            self.entries[path, algorithm] = (length, modified, inode, hash)
+
+    def lookup(self, node: FileNode, algorithm: str):
+        """查询索引，文件发生变化或者没有记录时返回None"""
+        self.visited.add(node.path)
+
+        entry = self.entries.get((node.path, algorithm))
+        if entry is not None and entry[:3] == (node.length, node.mtimeNs, node.inode):
+            return entry[3]
+        return None
+
+    def store(self, node: FileNode, algorithm: str, hash: str):
+        """记录新计算的校验(stat信息来自计算校验之前的扫描结果)"""
+        entry = (node.length, node.mtimeNs, node.inode, hash)
+        self.entries[node.path, algorithm] = self.updated[node.path, algorithm] = entry
+
+    def prune(self, rootDir: File):
+        """删除rootDir下本次运行中没有访问过的条目(已被删除或重命名的文件)"""
+        prefix = rootDir.path.rstrip('/') + '/'
+        removed = [k for k in self.entries if k[0].startswith(prefix) and k[0] not in self.visited]
+        for key in removed:
+            del self.entries[key]
+        self.connection.executemany('DELETE FROM hashes WHERE path = ? AND algorithm = ?', removed)
+
+    def save(self):
+        """将新计算的条目写入索引文件"""
+        self.connection.executemany('INSERT OR REPLACE INTO hashes VALUES (?, ?, ?, ?, ?, ?)',
+                                    [key + entry for key, entry in self.updated.items()])
+        self.connection.commit()
+        self.updated = {}
+
+    def close(self):
+        self.connection.close()
+
+
+class RemoteHashes:
+    """metadata策略下的校验来源
+
+    校验索引里没有的文件，如果大小和修改时间(纳秒)都与远程缓存的记录相同，就直接使用缓存里的校验，
+    不读取文件内容；都没有时返回None，由调用者计算
+    """
+
+    def __init__(self, rootDir: File, structure: list, algorithm: str, index: HashIndex = None):
+        self.algorithm = algorithm  # 远程缓存的校验算法，其它算法的校验只能计算
+        self.index = index
+        self.entries = {}  # 本地路径 -> (大小, 修改时间(纳秒), 校验)
+        self.incomplete = False  # 缓存中是否有没记录纳秒修改时间的文件(旧版本生成的缓存)
+        self.collect(rootDir.path.rstrip('/') + '/', structure)
+
+    def collect(self, prefix: str, structure: list):
+        for f in structure:
+            if 'children' in f:
+                self.collect(prefix + f['name'] + '/', f['children'])
+            elif f.get('hash'):
+                if f.get('modified_ns') is None:
+                    self.incomplete = True
+                else:
+                    self.entries[prefix + f['name']] = (f['length'], f['modified_ns'], f['hash'])
+
+    def lookup(self, node: FileNode, algorithm: str):
+        hash = self.index.lookup(node, algorithm) if self.index is not None else None
+        if hash is None and algorithm == self.algorithm:
+            entry = self.entries.get(node.path)
+            if entry is not None and entry[:2] == (node.length, node.mtimeNs):
+                return entry[2]
+        return hash
+
+    def store(self, node: FileNode, algorithm: str, hash: str):
+        if self.index is not None:
+            self.index.store(node, algorithm, hash)
@@ -0,0 +1,31 @@
+def keys_to_structure(entries):
+    """将对象存储列出的扁平key转换为目录结构，每个key只处理一次
+    :param entries: [(相对路径, 文件信息)]，目录以/结尾，文件信息为None；文件的文件信息会合并到结构条目里
+    :return: 与dir_hash格式相同的目录结构
+    """
+    structure = []
+    directories = {'': (structure, {})}  # 目录路径 -> (子文件列表, 文件名 -> 结构条目)
+
+    def directory(path):
+        if path not in directories:
+            parent, _, name = path.rpartition('/')
+            children, index = directory(parent)
+            entry = index.get(name)
+            if entry is None or 'children' not in entry:
+                entry = {'name': name, 'children': []}
+                children.append(entry)
+                index[name] = entry
+            directories[path] = (entry['children'], {})
+        return directories[path]
+
+    for path, info in entries:
+        if path.endswith('/'):
+            directory(path.rstrip('/'))
+        else:
+            parent, _, name = path.rpartition('/')
+            children, index = directory(parent)
+            entry = {'name': name, **info}
+            children.append(entry)
+            index[name] = entry
+
+    return structure
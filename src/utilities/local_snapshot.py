@@ -0,0 +1,159 @@
+from src.utilities.dir_hash import nodes_hashes, nodes_structure, stream_hashes
+from src.utilities.file import File
+from src.utilities.hash_algorithms import dump_structure
+from src.utilities.hash_index import HashIndex, RemoteHashes
+from src.utilities.tree_walker import scan_tree
+
+
+class LocalSnapshot:
+    """本地文件结构快照
+
+    一次上传过程中每个文件只读取一次：结构文件、文件差异计算和远程缓存需要的所有校验算法在第一次计算时一起计算，
+    之后都复用这里的结果
+    """
+
+    def __init__(self, rootDir: File, index: HashIndex = None, workers: int = 1, algorithm: str = 'sha1'):
+        self.rootDir = rootDir
+        self.index = index  # 本地校验索引，为None时总是完整计算校验
+        self.workers = workers  # 并行计算校验的线程/进程数
+        self.algorithm = algorithm  # 远程缓存使用的校验算法
+        self.algorithms = [algorithm]  # 本次运行需要的所有校验算法
+        self.nodes = {}  # 顶层目录名 -> 扫描结果
+        self.directories = {}  # (顶层目录名, 校验算法) -> 目录结构
+        self.structures = {}  # 校验算法 -> 根目录结构
+        self.streaming = {}  # 流水线模式下还在计算的结构：校验算法 -> 根目录结构
+        self.paths = {}  # 校验算法 -> {相对路径: 结构条目}，首次调用lookup()时建立
+
+    def require(self, algorithms: list):
+        """声明本次运行还需要哪些校验算法，必须在计算任何校验之前调用"""
+        for algorithm in algorithms:
+            if algorithm not in self.algorithms:
+                self.algorithms.append(algorithm)
+
+    def trustRemote(self, structure: list, algorithm: str):
+        """metadata策略：大小和修改时间与远程缓存相同的文件直接使用缓存里的校验，必须在计算任何校验之前调用
+        :return: 远程缓存是否缺少修改时间(需要更新缓存之后才能生效)
+        """
+        self.index = RemoteHashes(self.rootDir, structure, algorithm, self.index)
+        return self.index.incomplete
+
+    def missingAlgorithms(self, algorithm: str, computed):
+        """algorithm以及其它还没有计算过的校验算法(computed中没有的)"""
+        return [algorithm] + [a for a in self.algorithms if a != algorithm and a not in computed]
+
+    def directory(self, name: str, algorithm: str = None):
+        """获取顶层目录的结构(即<dir>.json的内容)，需要的校验算法在第一次访问时一起计算"""
+        algorithm = algorithm or self.algorithm
+        if name not in self.nodes:
+            self.nodes[name] = scan_tree(self.rootDir(name).path)
+        if (name, algorithm) not in self.directories:
+            algorithms = self.missingAlgorithms(algorithm, [a for n, a in self.directories if n == name])
+            structures = nodes_hashes(self.nodes[name], self.index, self.workers, algorithms)
+            for a in algorithms:
+                self.directories[name, a] = structures[a]
+        return self.directories[name, algorithm]
+
+    def getStructure(self, algorithm: str = None):
+        """获取整个根目录的结构
+
+        顶层目录复用directory()的结果，顶层文件(包括生成的结构文件)在首次访问时计算，
+        所以必须在结构文件生成之后再访问
+        """
+        algorithm = algorithm or self.algorithm
+        if algorithm not in self.structures:
+            if '' not in self.nodes:
+                self.nodes[''] = scan_tree(self.rootDir.path, recursive=False)
+            nodes = self.nodes['']
+            algorithms = self.missingAlgorithms(algorithm, self.structures)
+            files = nodes_hashes([f for f in nodes if f.isFile], self.index, self.workers, algorithms)
+            for a in algorithms:
+                entries = iter(files[a])
+                structure = []
+                for f in nodes:
+                    if f.isFile:
+                        structure.append(next(entries))
+                    else:
+                        structure.append({
+                            'name': f.name,
+                            'children': self.directory(f.name, a)
+                        })
+                self.structures[a] = structure
+        return self.structures[algorithm]
+
+    def streamStructure(self, algorithm: str = None, exclude=()):
+        """流水线模式下的getStructure()：先扫描出整个根目录的结构(校验留空)，遍历生成器时再按顺序计算校验
+        :param exclude: 不包含在内的顶层文件名(之后才生成的结构文件)，生成之后用addFiles()补上
+        :return: (结构, 生成器)，生成器产出(相对路径, 结构条目)，产出时条目的校验已经填好；
+                 遍历结束后所有需要的校验算法的结构都是完整的，getStructure()和directory()都会直接复用
+        """
+        algorithm = algorithm or self.algorithm
+        algorithms = self.missingAlgorithms(algorithm, ())
+        nodes = [f for f in scan_tree(self.rootDir.path) if not (f.isFile and f.name in exclude)]
+        for f in nodes:
+            if not f.isFile:
+                self.nodes[f.name] = f.children
+
+        pending = []
+        structures = nodes_structure(nodes, pending, algorithms)
+        for entries, f in pending:
+            for entry in entries.values():
+                entry['hash'] = ''  # 与远程列表中未知的校验一样留空，计算好之后再填写
+        prefix = self.rootDir.path.rstrip('/') + '/'
+
+        self.streaming = structures
+
+        def stream():
+            for entries, f in stream_hashes(pending, self.index, self.workers):
+                yield f.path[len(prefix):], entries[algorithm]
+            for a in algorithms:
+                self.structures[a] = structures[a]
+                for entry in structures[a]:
+                    if 'children' in entry:
+                        self.directories[entry['name'], a] = entry['children']
+
+        return structures[algorithm], stream()
+
+    def addFiles(self, names, algorithm: str = None):
+        """把streamStructure()时排除的顶层文件加入结构，需要在生成器遍历结束之后调用
+        :return: [(相对路径, 结构条目)]
+        """
+        algorithm = algorithm or self.algorithm
+        nodes = [f for f in scan_tree(self.rootDir.path, recursive=False) if f.isFile and f.name in names]
+        algorithms = [a for a in self.algorithms if a in self.structures]
+        files = nodes_hashes(nodes, self.index, self.workers, algorithms)
+        for a in algorithms:
+            self.structures[a] += files[a]
+            if a in self.paths:
+                self.paths[a].update((entry['name'], entry) for entry in files[a])
+        return [(entry['name'], entry) for entry in files[algorithm]]
+
+    def lookup(self, path: str, algorithm: str):
+        """查找文件在另一种校验算法下的校验，不再读取文件
+
+        需要先用require()声明这个算法，并且文件的校验已经计算过(流水线模式下是已经产出过的文件)
+        :param path: 相对路径
+        """
+        if algorithm not in self.paths:
+            structure = self.structures[algorithm] if algorithm in self.structures else self.streaming[algorithm]
+            self.paths[algorithm] = index_structure(structure)
+        return self.paths[algorithm][path]['hash']
+
+    @property
+    def structure(self):
+        return self.getStructure()
+
+    @property
+    def document(self):
+        """远程缓存文件的内容"""
+        return dump_structure(self.structure, self.algorithm)
+
+
+def index_structure(structure: list, prefix: str = '', result: dict = None):
+    """建立相对路径到文件结构条目的索引"""
+    result = {} if result is None else result
+    for f in structure:
+        if 'children' in f:
+            index_structure(f['children'], prefix + f['name'] + '/', result)
+        else:
+            result[prefix + f['name']] = f
+    return result
@@ -0,0 +1,21 @@
+from concurrent.futures import ThreadPoolExecutor
+
+
+def delete_deepest_first(paths, remove, workers: int = 4):
+    """并发删除远程文件/目录，按深度从深到浅分批进行
+
+    同一批里的路径深度相同，互相之间不可能是父子关系；上一批全部删完才开始下一批，
+    所以删除目录时，它下面的子目录一定已经删掉了
+    :param paths: 相对路径列表
+    :param remove: remove(相对路径)，会在多个线程中同时调用
+    :param workers: 同时删除的数量
+    """
+    levels = {}
+    for path in paths:
+        levels.setdefault(path.count('/'), []).append(path)
+
+    with ThreadPoolExecutor(workers) as executor:
+        for depth in sorted(levels, reverse=True):
+            # 遍历结果以便把删除时的异常抛出来
+            for _ in executor.map(remove, levels[depth]):
+                pass
@@ -0,0 +1,24 @@
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+
+def walk_remote(listdir, workers: int = 4):
+    """广度优先并发列出远程目录树
+    :param listdir: listdir(相对路径)返回该目录下的结构条目，目录条目带有空的children；
+                    相对路径为''(根目录)或以/结尾，会在多个线程中同时调用
+    :param workers: 同时列出的目录数
+    :return: 与dir_hash格式相同的目录结构
+    """
+    structure = []
+    with ThreadPoolExecutor(workers) as executor:
+        # 每发现一个目录就立即提交，不用等同一层的其它目录列完
+        pending = {executor.submit(listdir, ''): ('', structure)}
+        while len(pending) > 0:
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                path, children = pending.pop(future)
+                for entry in future.result():
+                    children.append(entry)
+                    if 'children' in entry:
+                        subdir = path + entry['name'] + '/'
+                        pending[executor.submit(listdir, subdir)] = (subdir, entry['children'])
+    return structure
@@ -0,0 +1,56 @@
+import os
+
+from src.utilities.file import File
+from src.utilities.hash_algorithms import hashAlgorithms
+
+
+class FileNode:
+    """目录扫描结果，stat信息在扫描时一次性获取并缓存，访问属性不会产生额外的系统调用"""
+    __slots__ = ('name', 'path', 'isDirectory', 'length', 'modified', 'mtimeNs', 'inode', 'children')
+
+    def __init__(self, name: str, path: str, isDirectory: bool, stat=None, children: list = None):
+        self.name = name
+        self.path = path
+        self.isDirectory = isDirectory
+        self.length = stat.st_size if stat is not None else None
+        self.modified = int(stat.st_mtime) if stat is not None else None
+        self.mtimeNs = stat.st_mtime_ns if stat is not None else None
+        self.inode = stat.st_ino if stat is not None else None
+        self.children = children
+
+    @property
+    def isFile(self):
+        return not self.isDirectory
+
+    @property
+    def sha1(self):
+        return self.digest('sha1')
+
+    def digest(self, algorithm: str):
+        # 扫描时已经确认过是文件，不需要再经过File.sha1的检查
+        return File(self.path).checksum(hashAlgorithms[algorithm]())
+
+    def digests(self, algorithms: list):
+        """只读取一次文件，同时计算多种校验"""
+        return File(self.path).checksums([hashAlgorithms[algorithm]() for algorithm in algorithms])
+
+    def __repr__(self):
+        return str(__class__) + ': ' + self.name
+
+
+def scan_tree(path: str, recursive: bool = True):
+    """使用os.scandir扫描目录
+    :param path: 目录路径(使用/作为分隔符)
+    :param recursive: 是否扫描子目录，为False时子目录的children为None
+    :return: FileNode列表，顺序与File.files相同
+    """
+    nodes = []
+    with os.scandir(path) as it:
+        for entry in it:
+            entryPath = path.rstrip('/') + '/' + entry.name
+            if entry.is_dir():
+                children = scan_tree(entryPath) if recursive else None
+                nodes.append(FileNode(entry.name, entryPath, True, children=children))
+            elif entry.is_file():
+                nodes.append(FileNode(entry.name, entryPath, False, stat=entry.stat()))
+    return nodes
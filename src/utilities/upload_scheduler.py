@@ -0,0 +1,37 @@
+smallFileSize = 256 * 1024  # 小于这个大小的文件会被分批上传
+
+
+def schedule_uploads(newFiles: dict, batchSize: int = 1):
+    """安排上传顺序
+
+    文件按从大到小的顺序上传，避免大文件排在最后拖长总耗时；小文件每batchSize个分为一批，
+    同一批文件由同一个工作线程连续上传，以减少任务调度的开销
+    :param newFiles: FileComparer2.newFiles
+    :param batchSize: 每批小文件的数量，为1时不分批
+    :return: 批次列表，每个批次是[(相对路径, 文件大小, 文件校验)]
+    """
+    files = sorted(((path, v[0], v[1]) for path, v in newFiles.items()), key=lambda f: f[1], reverse=True)
+    large = [[f] for f in files if f[1] >= smallFileSize or batchSize <= 1]
+    small = [f for f in files if f[1] < smallFileSize and batchSize > 1]
+    return large + [small[i:i + batchSize] for i in range(0, len(small), batchSize)]
+
+
+def stream_uploads(files, batchSize: int = 1):
+    """流水线模式下安排上传
+
+    文件是边对比边产出的，无法预先排序：大文件产出后立即单独作为一批，小文件凑满batchSize个再一起交出
+    :param files: 可迭代的(相对路径, 文件大小, 文件校验)，比如FileComparer2.iterNewFiles()
+    :param batchSize: 每批小文件的数量，为1时不分批
+    :return: 生成器，产出批次[(相对路径, 文件大小, 文件校验)]
+    """
+    small = []
+    for f in files:
+        if f[1] >= smallFileSize or batchSize <= 1:
+            yield [f]
+        else:
+            small.append(f)
+            if len(small) >= batchSize:
+                yield small
+                small = []
+    if len(small) > 0:
+        yield small
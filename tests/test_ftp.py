@@ -0,0 +1,113 @@
+"""Ftp的连接测试：主连接空闲超时被服务器断开后，创建目录和更新缓存要能自动重连"""
+from ftplib import error_temp, error_perm
+from types import SimpleNamespace
+
+import pytest
+
+from src.service_provider.Ftp import Ftp, FtpClient
+
+
+class FakeServer:
+    def __init__(self):
+        self.files = {}
+        self.dirs = {'/'}
+
+
+class FakeFtp:
+    """模拟ftplib.FTP，expired为True时下一条命令返回421(空闲超时)"""
+
+    def __init__(self, server: FakeServer):
+        self.server = server
+        self.expired = False
+        self.connects = 0
+
+    def connect(self, host, port, timeout):
+        self.connects += 1
+
+    def login(self, user, passwd):
+        pass
+
+    def getwelcome(self):
+        return ''
+
+    def close(self):
+        pass
+
+    def check(self):
+        if self.expired:
+            raise error_temp('421 Timeout.')
+
+    def nlst(self, path):
+        self.check()
+        path = path.rstrip('/') or '/'
+        if path not in self.server.dirs:
+            raise error_perm('550 No such directory')
+        return [p for p in list(self.server.files) + list(self.server.dirs) if p != '/' and p.rsplit('/', 1)[0] == path]
+
+    def mkd(self, path):
+        self.check()
+        self.server.dirs.add(path.rstrip('/'))
+
+    def delete(self, path):
+        self.check()
+        if self.server.files.pop(path, None) is None:
+            raise error_perm('550 No such file')
+
+    def storbinary(self, command, buf):
+        self.check()
+        self.server.files[command[len('STOR '):]] = buf.read()
+
+
+@pytest.fixture
+def ftp(monkeypatch):
+    server = FakeServer()
+    connections = []
+
+    def createFtp(client):
+        connection = FakeFtp(server)
+        connections.append(connection)
+        return connection
+
+    monkeypatch.setattr(FtpClient, 'createFtp', createFtp)
+    config = {'host': 'localhost', 'port': 21, 'user': '', 'password': '', 'base_path': '/base',
+              'secure': False, 'prot_p': False, 'cache_file': '.cache.json'}
+    uploadTool = SimpleNamespace(config={}, debugMode=False, snapshot=SimpleNamespace(document='[]'))
+    provider = Ftp(uploadTool, config)
+    provider.initialize(None)
+    return provider, server, connections
+
+
+def test_client_run_reconnects_once():
+    client = FtpClient('localhost', 21, '', '', False, False)
+    calls = []
+
+    def func(c):
+        calls.append(c.ftp)
+        if len(calls) == 1:
+            raise EOFError()
+        return 'ok'
+
+    client.ftp = SimpleNamespace(close=lambda: None)
+    client.createFtp = lambda: SimpleNamespace(close=lambda: None)
+    client.open = lambda timeout, verbose: None
+    assert client.run(func) == 'ok'
+    assert calls[0] is not calls[1]
+
+
+def test_directories_after_idle_timeout(ftp):
+    provider, server, connections = ftp
+    connections[0].expired = True
+
+    provider.makeDirectory('a')
+    assert '/base/a' in server.dirs
+    assert provider.ftp.ftp is not connections[0]
+
+
+def test_cache_written_after_idle_timeout(ftp):
+    provider, server, connections = ftp
+    server.files['/base/.cache.json'] = b'old'
+    provider.modified = True
+    connections[0].expired = True
+
+    provider.cleanup()
+    assert server.files['/base/.cache.json'] == b'[]'
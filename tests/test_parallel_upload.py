@@ -0,0 +1,139 @@
+"""ParallelUploadServiceProvider的故障注入测试：任何失败组合下上传都必须结束，不能死锁"""
+import random
+from threading import Thread, Lock
+from types import SimpleNamespace
+
+import pytest
+
+from src.service_provider.ParallelUploadServiceProvider import ParallelUploadServiceProvider
+
+timeout = 10  # 超过这个时间(秒)还没结束就认为死锁了
+
+
+class FakeProvider(ParallelUploadServiceProvider):
+    """按文件名注入故障：permanent里的文件总是失败，transient里的文件失败指定次数之后成功"""
+
+    def __init__(self, threads=4, adaptive=False, permanent=(), transient=None):
+        config = {'upload_retries': 2, 'progress_interval': 0.05, 'upload_adaptive': adaptive}
+        super(FakeProvider, self).__init__(SimpleNamespace(config=config, debugMode=False), {})
+        self.threads = threads
+        self.permanent = set(permanent)
+        self.transient = dict(transient or {})
+        self.uploaded = []
+        self.lock = Lock()
+
+    def fetchAll(self):
+        return []
+
+    def deleteObjects(self, paths):
+        pass
+
+    def deleteDirectories(self, paths):
+        pass
+
+    def makeDirectory(self, path):
+        pass
+
+    def getName(self):
+        return 'fake'
+
+    def uploadObject(self, path, localPath, baseDir, length, hash):
+        self.addUploadTask(path, length, path)
+
+    def uploadWorker(self, task):
+        with self.lock:
+            if task in self.permanent:
+                raise IOError(f'permanent failure: {task}')
+            if self.transient.get(task, 0) > 0:
+                self.transient[task] -= 1
+                raise IOError(f'transient failure: {task}')
+            self.uploaded.append(task)
+
+
+def files(names):
+    return [(name, '/nonexistent/' + name, 1, '') for name in names]
+
+
+def run(provider, batches=None):
+    """在单独的线程中上传，超时未结束即判定为死锁；返回上传时抛出的异常"""
+    result = {}
+
+    def target():
+        try:
+            provider.startParallelUploadWork(provider.threads, batches, '/nonexistent')
+        except BaseException as e:
+            result['error'] = e
+
+    thread = Thread(target=target, daemon=True)
+    thread.start()
+    thread.join(timeout)
+    assert not thread.is_alive(), '并行上传没有结束(死锁)'
+    return result.get('error')
+
+
+@pytest.fixture(autouse=True)
+def no_backoff(monkeypatch):
+    # 重试的退避时间为0
+    monkeypatch.setattr(random, 'uniform', lambda a, b: 0.0)
+
+
+def test_permanent_failures_are_recorded():
+    names = [f'f{i}' for i in range(50)]
+    provider = FakeProvider(permanent=names[::5])
+    for i in range(0, len(names), 8):
+        provider.uploadObjects(files(names[i:i + 8]), '/nonexistent')
+
+    assert run(provider) is None
+    assert sorted(name for name, _ in provider.uploadFailures) == sorted(names[::5])
+    assert len(provider.uploaded) == len(names) - len(names[::5])
+    assert provider.uploadFinished == provider.uploadTaskTotal == len(names)
+
+
+def test_transient_failures_are_retried():
+    names = [f'f{i}' for i in range(30)]
+    provider = FakeProvider(adaptive=True, transient={name: 2 for name in names[::3]})
+    provider.uploadObjects(files(names), '/nonexistent')
+
+    assert run(provider) is None
+    assert provider.uploadFailures == []
+    assert sorted(provider.uploaded) == sorted(names)
+    assert provider.uploadErrors == 2 * len(names[::3])
+
+
+def test_streaming_with_failures_and_full_queue():
+    # 批次数远多于队列容量(threads*2)，且所有文件都失败
+    names = [f'f{i}' for i in range(100)]
+    provider = FakeProvider(threads=2, permanent=names)
+    batches = (files(names[i:i + 3]) for i in range(0, len(names), 3))
+
+    assert run(provider, batches) is None
+    assert len(provider.uploadFailures) == len(names)
+    assert provider.uploadProducing is False
+
+
+def test_producer_exception_is_raised():
+    def batches():
+        yield files(['a', 'b'])
+        raise ValueError('producer failed')
+
+    provider = FakeProvider(permanent=['b'])
+    error = run(provider, batches())
+    assert isinstance(error, ValueError)
+    assert provider.uploaded == ['a']
+    assert provider.uploadProducing is False
+
+
+def test_producer_exception_before_first_batch():
+    def batches():
+        raise ValueError('producer failed')
+        yield
+
+    assert isinstance(run(FakeProvider(), batches()), ValueError)
+
+
+@pytest.mark.parametrize('batches', [None, iter([]), iter([[], []])])
+def test_empty_stream(batches):
+    provider = FakeProvider()
+    assert run(provider, batches) is None
+    assert provider.uploadTaskTotal == provider.uploadFinished == 0
+    assert provider.uploadFailures == []
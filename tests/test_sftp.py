@@ -0,0 +1,160 @@
+"""SFTP的测试：通道池重开断开的通道、fast_delete的路径限制和rm -rf批量删除、创建已经存在的目录"""
+import errno
+import shlex
+from types import SimpleNamespace
+
+import paramiko
+import pytest
+
+from src.service_provider.SFTP import SFTP, SFTPChannelPool, SFTPClient
+
+base = '/srv/base'
+
+
+class FakeChannel:
+    def __init__(self):
+        self.closed = False
+
+    def get_channel(self):
+        return SimpleNamespace(closed=self.closed)
+
+
+class FakeClient:
+    def __init__(self):
+        self.opened = []
+
+    def open_channel(self):
+        channel = FakeChannel()
+        self.opened.append(channel)
+        return channel
+
+
+@pytest.fixture
+def sftp():
+    config = {'host': 'localhost', 'port': 22, 'user': '', 'usePkey': False, 'pkeyFile': None, 'password': '',
+              'basePath': base, 'cache_file': '.cache.json', 'fast_delete': True}
+    provider = SFTP(SimpleNamespace(config={}, debugMode=False), config)
+    provider.sftp.cwd = base
+    provider.commands = []
+
+    def exec_command(command):
+        provider.commands.append(shlex.split(command)[3:])
+        return provider.status.pop(0) if len(provider.status) > 0 else (0, '')
+
+    provider.status = []
+    provider.sftp.exec_command = exec_command
+    return provider
+
+
+def test_pool_reopens_closed_channel():
+    client = FakeClient()
+    pool = SFTPChannelPool(client, 1)
+    used = []
+
+    def func(channel):
+        used.append(channel)
+        if len(used) == 1:
+            channel.closed = True
+            raise EOFError()
+        return 'ok'
+
+    assert pool.run(func) == 'ok'
+    assert used == client.opened
+    assert len(used) == 2 and used[0] is not used[1]
+    # 断开的通道被替换掉，之后复用新的通道
+    assert pool.channels == [used[1]]
+    assert pool.run(lambda channel: channel) is used[1]
+
+
+@pytest.mark.parametrize('error', [IOError(errno.EACCES, 'Permission denied'), paramiko.SSHException('failure')])
+def test_pool_raises_server_error_on_live_channel(error):
+    client = FakeClient()
+    pool = SFTPChannelPool(client, 1)
+
+    def func(channel):
+        raise error
+
+    with pytest.raises(type(error)):
+        pool.run(func)
+    assert len(client.opened) == 1
+    # 出错之后通道仍然归还到池里
+    assert pool.run(lambda channel: channel) is client.opened[0]
+
+
+@pytest.mark.parametrize('path, expected', [
+    ('a', base + '/a'),
+    ('a/b/c.txt', base + '/a/b/c.txt'),
+    ('a/../b', base + '/b'),
+    ('./a/', base + '/a'),
+])
+def test_confine(sftp, path, expected):
+    assert sftp.confine(path) == expected
+
+
+@pytest.mark.parametrize('path', ['', '.', 'a/..', '..', '../x', 'a/../../x', '../base2', '/etc', '/srv/base'])
+def test_confine_rejects_paths_outside_base(sftp, path):
+    with pytest.raises(ValueError):
+        sftp.confine(path)
+
+
+def test_remove_remotely(sftp):
+    assert sftp.remove_remotely(['a', 'a/b', 'a/b/c.txt', 'd e', 'f/g']) == []
+    # 已经被上层目录包含的路径不会单独出现在命令里，含空格的路径作为一个参数
+    assert sftp.commands == [[base + '/a', base + '/d e', base + '/f/g']]
+
+
+def test_remove_remotely_rejects_outside_paths_before_running(sftp):
+    with pytest.raises(ValueError):
+        sftp.remove_remotely(['a', '../other'])
+    assert sftp.commands == []
+
+
+def test_remove_remotely_splits_long_commands(sftp):
+    sftp.commandLength = 32
+    paths = [f'dir{i}' for i in range(6)]
+    assert sftp.remove_remotely(paths) == []
+    assert len(sftp.commands) > 1
+    assert sum(sftp.commands, []) == [base + '/' + p for p in paths]
+
+
+def test_remove_remotely_returns_remaining_paths_on_failure(sftp):
+    sftp.commandLength = 32
+    sftp.status = [(0, ''), (1, 'rm: Permission denied')]
+    paths = [f'dir{i}' for i in range(6)] + ['dir5/x']
+    remaining = sftp.remove_remotely(paths)
+    removed = sftp.commands[0]
+    assert len(sftp.commands) == 2
+    # 第一条命令已经删掉的不再返回，之后的路径(包括被包含的子路径)交给调用者逐个删除
+    assert sorted(remaining) == sorted(p for p in paths if base + '/' + p.split('/')[0] not in removed)
+
+
+def test_remove_remotely_without_exec_permission(sftp):
+    def exec_command(command):
+        raise paramiko.SSHException('exec not allowed')
+
+    sftp.sftp.exec_command = exec_command
+    assert sorted(sftp.remove_remotely(['a', 'a/b'])) == ['a', 'a/b']
+
+
+def test_create_existing_directory():
+    client = SFTPClient('localhost', 22, '', False, None, '')
+    dirs, files = {'a'}, {'f'}
+
+    def mkdir(path, mode):
+        if path in dirs or path in files:
+            raise IOError('Failure')
+        dirs.add(path)
+
+    def stat(path):
+        if path in dirs:
+            return SimpleNamespace(st_mode=0o40755)
+        if path in files:
+            return SimpleNamespace(st_mode=0o100644)
+        raise IOError(errno.ENOENT, 'No such file')
+
+    client.sftp = SimpleNamespace(mkdir=mkdir, stat=stat)
+    client.create_directory('a')
+    client.create_directory('b')
+    assert dirs == {'a', 'b'}
+    with pytest.raises(IOError):
+        client.create_directory('f')